@@ -9,26 +9,29 @@ It should:
 import warnings
 warnings.filterwarnings("ignore")
 from datetime import datetime, timedelta
-import csv
-from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm  # For progress bar
-from multiprocessing import Manager
 from sugarstats import *
+from nscache import cachedretrieve, evict
+from resultstore import ResultStore
+from checkpoint import Checkpoint, patientkey
+from streamwriter import idkey
+from tableio import readrows, openwriter
+from functools import partial
+from rollups import rollup, localdays, FIELDS
 
 def startA1cdate(endA1cdate, days = 90):
     startA1cdate = (datetime.fromisoformat(endA1cdate) - timedelta(days)).isoformat().split("T")[0]
     return startA1cdate
 
-def A1cdata(ns_uuid, A1cDate, days = 90):
-    data, responseurl = dataretrieve(ns_uuid, startA1cdate(A1cDate, days), A1cDate)
-    return data, responseurl
+def A1cwindow(A1cDate, days = 90):
+    return startA1cdate(A1cDate, days), A1cDate
 
-def process_A1c(row, ptA1cDate, ptA1c, ptNSCol, days, base_columns):
+def process_A1c(row, windowdata, ptA1cDate, ptA1c, days, base_columns):
     """Process A1c data and return relevant statistics or empty values if no data."""
     A1c_date = row[ptA1cDate]  # Access by index for lists
     if A1c_date:
-        data, response_url = A1cdata(row[ptNSCol], A1c_date, days)
+        data = windowdata[A1cwindow(A1c_date, days)]
         if data:
             A1c_value = row[ptA1c]  # Access by index for lists
             return GMIstats(data, days) + (A1c_value, A1c_date), data
@@ -36,12 +39,37 @@ def process_A1c(row, ptA1cDate, ptA1c, ptNSCol, days, base_columns):
     return ("",) * len(base_columns), []
 
 
-def process_row(row, a1c_mappings, ptIDCol, ptLinkCol, ptNSCol, days, base_columns):
+def A1cwindows(row, a1c_mappings, days = 90):
+    return [A1cwindow(row[ptA1cDate], days) for ptA1cDate, ptA1c in a1c_mappings if row[ptA1cDate]]
+
+def process_row(row, a1c_mappings, ptIDCol, ptLinkCol, ptNSCol, days, base_columns, refresh=0, windowdata=None,
+                stored=None):
+    """
+    :param windowdata: dict, data of the windows when it was already retrieved asynchronously
+    :param stored: dict, {(start, A1c date): [stats, dailies]} of windows computed in an earlier run
+    :return: (result row or [], daily averages, {(start, A1c date): [stats, dailies]} of newly computed windows,
+             False when retrieving any window failed)
+    """
+    stored = stored or {}
     results = []
     daily_data = []
+    computed = {}
+    # Retrieve every A1c window in as few requests as possible
+    if windowdata is None:
+        missing = [window for window in A1cwindows(row, a1c_mappings, days) if window not in stored]
+        windowdata = planretrieve(row[ptNSCol], missing, retrieve=partial(cachedretrieve, refresh=refresh))
+    fetched = not any(data == "" for data in windowdata.values())
     for ptA1cDate, ptA1c in a1c_mappings:
-        result, data = process_A1c(row, ptA1cDate, ptA1c, ptNSCol, days, base_columns)
-        dailies = daily_avg_blood_sugar(data, row[ptIDCol])
+        window = A1cwindow(row[ptA1cDate], days) if row[ptA1cDate] else None
+        if window in stored:
+            stats, dailies = stored[window]
+            result = (*stats, row[ptA1c], row[ptA1cDate])
+            dailies = [(row[ptIDCol], *daily) for daily in dailies]
+        else:
+            result, data = process_A1c(row, windowdata, ptA1cDate, ptA1c, days, base_columns)
+            dailies = daily_avg_blood_sugar(data, row[ptIDCol])
+            if result[0]:
+                computed[window] = [list(result[:-2]), [daily[1:] for daily in dailies]]
         results.extend(result)
         daily_data.extend(dailies)
 
@@ -50,86 +78,131 @@ def process_row(row, a1c_mappings, ptIDCol, ptLinkCol, ptNSCol, days, base_colum
             int(float(row[ptIDCol].replace(',', ''))),
             row[ptLinkCol],
             *results
-        ], daily_data
-    return [], []  # Return empty lists instead of None
+        ], daily_data, computed, fetched
+    return [], [], computed, fetched  # Return empty lists instead of None
 
 
 def daily_avg_blood_sugar(daily_data, ptID):
-    """Calculate daily average blood sugar and export to CSV"""
-    daily_sgv = defaultdict(list)
-    for entry in daily_data:
-        if 'sgv' in entry:
-            date = datetime.fromtimestamp(entry['date'] / 1000).strftime('%Y-%m-%d')
-            daily_sgv[date].append(entry['sgv'])
-
-    daily_avg_results = [(ptID, date, sum(sgv_list) / len(sgv_list), len(sgv_list)) for date, sgv_list in daily_sgv.items()]
-    return daily_avg_results
-
-
-def a1cgmi(days=90):
+    """Calculate daily average blood sugar per local day"""
+    if not len(daily_data):
+        return []
+    days, table = rollup(daily_data, localdays(daily_data.date).astype(np.int64))
+    count, total = table[:, FIELDS.index("count")], table[:, FIELDS.index("sum")]
+    return [(ptID, str(day), total / count, count)
+            for day, total, count in zip(days.astype("datetime64[D]"), total.tolist(), count.tolist()) if count]
+
+
+def a1cgmi(days=90, refresh=0, mode="process", incremental=True, resume=False, order=False, fmt="csv"):
+    """
+    :param mode: str, "process" retrieves and computes in a process pool, "async" retrieves all patients through
+                 one asynchronous connection pool and only computes stats in worker processes
+    :param incremental: bool, reuse the stored results of windows computed in earlier runs
+    :param resume: bool, skip the patients an interrupted run already finished
+    :param order: bool, sort the outputs by patient ID instead of writing patients as they finish
+    :param fmt: str, "csv" or "parquet" output files
+    """
     snap = 'gitignore/DPD 2024-10-30.csv'
 
-    with open(snap, mode="r") as snapdata:
-        readfile = csv.reader(snapdata)
-        headers = next(readfile)
-
-        # Define column indices
-        ptIDCol = headers.index('DPD_ID')
-        ptLinkCol = headers.index('link')
-        ptNSCol = headers.index('ns_uuid')
-        ptA1c1 = headers.index('A1c')
-        ptA1c1date = headers.index('A1c_datetime')
-        ptA1c2 = headers.index('A1c_previous')
-        ptA1c2date = headers.index('A1c_previous_datetime')
-        ptA1c3 = headers.index('A1c_3d_most_recent')
-        ptA1c3date = headers.index('A1c_3d_most_recent_datetime')
-
-        a1c_mappings = [
-            (ptA1c1date, ptA1c1),
-            (ptA1c2date, ptA1c2),
-            (ptA1c3date, ptA1c3)
-        ]
-
-        base_columns = ["cgm", "count", "percentdata", "avgglucose", "STD", "ptGMI", "TBR", "TIR (3.9–10 mmol/L)",
-                        "TAR","verylow (<3 mmol/L)", "low (3–3.9 mmol/L)", "high (10–13.9 mmol/L)", "veryhigh (>13.8 mmol/L)",
-                        "timefluc", "timerapid", "A1c_value", "A1c_date"]
-        final_headers = ["ID", "link"] + [f"{col}{i}" for i in range(1, 4) for col in base_columns]
-
-        # Read all rows into a list to count them for progress bar
-        rows = list(readfile)
-
-        # Set up shared lists
-        manager = Manager()
-        results = manager.list()
-        all_daily_data = manager.list()
-
-        # Updated ProcessPoolExecutor with shared list for daily data
+    # Keep the local data cache within its size limit
+    evict()
+
+    headers, rows = readrows(snap)
+
+    # Define column indices
+    ptIDCol = headers.index('DPD_ID')
+    ptLinkCol = headers.index('link')
+    ptNSCol = headers.index('ns_uuid')
+    ptA1c1 = headers.index('A1c')
+    ptA1c1date = headers.index('A1c_datetime')
+    ptA1c2 = headers.index('A1c_previous')
+    ptA1c2date = headers.index('A1c_previous_datetime')
+    ptA1c3 = headers.index('A1c_3d_most_recent')
+    ptA1c3date = headers.index('A1c_3d_most_recent_datetime')
+
+    a1c_mappings = [
+        (ptA1c1date, ptA1c1),
+        (ptA1c2date, ptA1c2),
+        (ptA1c3date, ptA1c3)
+    ]
+
+    base_columns = ["cgm", "count", "percentdata", "avgglucose", "STD", "ptGMI", "TBR", "TIR (3.9–10 mmol/L)",
+                    "TAR","verylow (<3 mmol/L)", "low (3–3.9 mmol/L)", "high (10–13.9 mmol/L)", "veryhigh (>13.8 mmol/L)",
+                    "timefluc", "timerapid", "A1c_value", "A1c_date"]
+    final_headers = ["ID", "link"] + [f"{col}{i}" for i in range(1, 4) for col in base_columns]
+    base_types = ["str", "int"] + ["float"] * 14 + ["str"]
+    final_types = ["int", "str"] + base_types * 3
+
+    # Results and daily averages are written as patients finish
+    results = openwriter(f"gitignore/results_{str(days)}", final_headers, final_types,
+                         orderby=(lambda result: idkey(result[0])) if order else None, fmt=fmt)
+    all_daily_data = openwriter(f"gitignore/daily_avg_blood_sugar_{str(days)}",
+                                ["ID", "Date", "Average Blood Sugar", "Data Points"], ["int", "str", "float", "int"],
+                                orderby=(lambda daily: (idkey(daily[0]), daily[1])) if order else None, fmt=fmt)
+
+    # Results of earlier runs, only new or invalidated windows are computed again
+    store = ResultStore(f"gitignore/resultstore_a1c_{str(days)}.csv", STATSVERSION, settle=refresh)
+    def storedfor(row):
+        return store.patient(row[ptNSCol]) if incremental else {}
+
+    # Finished patients are checkpointed durably as they complete
+    checkpoint = Checkpoint(f"gitignore/checkpoint_a1c_{str(days)}.csv", resume)
+    for result, daily_data in checkpoint.outputs():
+        if result:
+            results.writerow(result)
+            all_daily_data.writerows(daily_data)
+    rows = [row for row in rows if patientkey(row, ptIDCol, ptNSCol) not in checkpoint.done]
+
+    def keep(row, output):
+        result, daily_data, computed, fetched = output
+        for (start, end), value in computed.items():
+            store.put(row[ptNSCol], start, end, value)
+        # Patients whose data could not be retrieved are not done, a resumed run tries them again
+        if fetched:
+            checkpoint.put(patientkey(row, ptIDCol, ptNSCol), [result, daily_data])
+        return result, daily_data
+
+    if mode == "async":
+        # Asynchronous retrieval, stats in a small process pool
+        from asyncretrieve import runcohort
+        with tqdm(total=len(rows), desc="Processing Patients") as progress:
+            def onresult(row, output):
+                progress.update()
+                result, daily_data = keep(row, output)
+                if result:
+                    results.writerow(result)
+                    all_daily_data.writerows(daily_data)
+
+            def windowfn(row):
+                stored = storedfor(row)
+                return [window for window in A1cwindows(row, a1c_mappings, days) if window not in stored]
+
+            computefn = partial(process_row, a1c_mappings=a1c_mappings, ptIDCol=ptIDCol, ptLinkCol=ptLinkCol,
+                                ptNSCol=ptNSCol, days=days, base_columns=base_columns)
+            runcohort(rows, windowfn, computefn, onresult, nsfn=lambda row: row[ptNSCol], refresh=refresh,
+                      extrafn=lambda row: {"stored": storedfor(row)})
+    else:
+        # Collect patients in the order they finish so a slow one does not hold up the rest
         with ProcessPoolExecutor() as executor:
-            futures = [
-                executor.submit(process_row, row, a1c_mappings, ptIDCol, ptLinkCol, ptNSCol, days, base_columns)
+            futures = {
+                executor.submit(process_row, row, a1c_mappings, ptIDCol, ptLinkCol, ptNSCol, days, base_columns, refresh,
+                                stored=storedfor(row)): row
                 for row in rows
-            ]
+            }
 
-            for future in tqdm(futures, total=len(rows), desc="Processing Patients"):
+            for future in tqdm(as_completed(futures), total=len(rows), desc="Processing Patients"):
                 try:
-                    result, daily_data = future.result()
+                    result, daily_data = keep(futures.pop(future), future.result())
                     if result:
-                        results.append(result)
-                        all_daily_data.extend(daily_data)
+                        results.writerow(result)
+                        all_daily_data.writerows(daily_data)
                 except Exception as e:
                     print(f"Error processing row: {e}")
 
-        # Write main results to CSV
-        with open(f"gitignore/results_{str(days)}.csv", 'w', newline='', buffering=1) as f:
-            writer = csv.writer(f)
-            writer.writerow(final_headers)  # Write header
-            writer.writerows(results)  # Write all results at once
-
-        print("Results exported.")
+    store.close()
+    results.close()
+    print("Results exported.")
 
-        with open(f"gitignore/daily_avg_blood_sugar_{str(days)}.csv", 'w', newline='', buffering=1) as f:
-            writer = csv.writer(f)
-            writer.writerow(["ID", "Date", "Average Blood Sugar", "Data Points"])  # Write header
-            writer.writerows(all_daily_data)
+    all_daily_data.close()
+    checkpoint.finish()
 
-        print("Daily results exported.")
\ No newline at end of file
+    print("Daily results exported.")
\ No newline at end of file
@@ -0,0 +1,270 @@
+"""
+This module retrieves nightscout data with asyncio instead of one blocking process per patient.
+
+One aiohttp session keeps pooled keep-alive connections, an adaptive limit sets the number of requests in flight from
+the observed latency and errors, and requests to the same host are spaced out. Retries follow a RetryPolicy, so hosts
+that are down or undeployed fail fast instead of taking slots from healthy ones. Stats are only handed to a small
+process pool once a patient's data has arrived.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import aiohttp
+from data_via_nsuuid import *
+import data_via_nsuuid
+import nscache
+import retrypolicy
+import runreport
+
+
+class HostLimiter:
+    """Allow at most `rate` requests per second to each host (keyed by nightscout site, one host each in production)."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.nextslot = {}
+
+    async def wait(self, host):
+        now = time.monotonic()
+        slot = max(now, self.nextslot.get(host, 0))
+        self.nextslot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class AdaptiveLimit:
+    """
+    Number of requests in flight, adapted with additive increase and multiplicative decrease.
+
+    The limit grows by one for every limit's worth of answers faster than `latency` seconds. It halves on a transient
+    failure or a slower answer, at most once per `latency` seconds so a burst of failures counts once. Permanent
+    failures (see retrypolicy.isfatal) say nothing about the load and leave it unchanged.
+
+    :param maximum: int, highest limit
+    :param minimum: int, lowest limit
+    :param initial: int, starting limit (a quarter of the maximum by default)
+    :param latency: float, seconds to the response headers above which an answer counts as slow
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, latency=5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 4))
+        self.latency = latency
+        self.inflight = 0
+        self.lastdecrease = 0
+        self.waiters = []
+
+    async def acquire(self):
+        while self.inflight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.inflight += 1
+
+    def release(self, elapsed=None, failed=False):
+        """
+        :param elapsed: float, seconds to the response headers, or None without an answer
+        :param failed: bool, whether the request failed transiently
+        """
+        self.inflight -= 1
+        now = time.monotonic()
+        if failed or (elapsed is not None and elapsed > self.latency):
+            if now - self.lastdecrease > self.latency:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.lastdecrease = now
+        elif elapsed is not None:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def slot(self):
+        return Slot(self)
+
+
+class Slot:
+    """One request in flight, used as `async with limit.slot() as slot:` calling slot.answered() on the headers."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.elapsed = None
+
+    async def __aenter__(self):
+        await self.limit.acquire()
+        self.sent = time.monotonic()
+        return self
+
+    def answered(self):
+        self.elapsed = time.monotonic() - self.sent
+
+    async def __aexit__(self, kind, error, traceback):
+        # Cancellations are neither successes nor failures
+        failed = isinstance(error, Exception) and not retrypolicy.isfatal(error)
+        self.limit.release(self.elapsed if error is None or failed else None, failed)
+
+
+class AsyncRetriever:
+    """
+    Shared asynchronous nightscout client, used as `async with AsyncRetriever() as retriever:`.
+
+    :param maxinflight: int, most requests in flight at once
+    :param hostrate: float, requests per second allowed to a single host (0 for no limit)
+    :param keepalive: float, seconds an idle pooled connection is kept open
+    :param latency: float, seconds to the response headers above which requests in flight are cut (see AdaptiveLimit)
+    :param policy: RetryPolicy, the process wide one by default
+    :param chunk: int, days per chunk of long ranges (0 for a single request), data_via_nsuuid.chunkdays by default
+    """
+
+    def __init__(self, maxinflight=32, hostrate=5, keepalive=30, latency=5, policy=None, chunk=None):
+        self.maxinflight = maxinflight
+        self.keepalive = keepalive
+        self.latency = latency
+        self.limiter = HostLimiter(hostrate)
+        self.policy = policy or retrypolicy.policy
+        self.chunkdays = data_via_nsuuid.chunkdays if chunk is None else chunk
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.maxinflight, keepalive_timeout=self.keepalive)
+        timeout = aiohttp.ClientTimeout(sock_connect=20, sock_read=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.slots = AdaptiveLimit(self.maxinflight, latency=self.latency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    # Obtain data, same return values as data_via_nsuuid.dataretrieve, long ranges as concurrent chunks
+    async def dataretrieve(self, ns_uuid, startDate, endDate, max_retries=10):
+        if not ns_uuid:
+            return "", ""
+
+        with runreport.stage("dataretrieve"):
+            chunks = chunkranges(startDate, endDate, self.chunkdays)
+            if len(chunks) > 1:
+                runreport.count("chunked ranges")
+                fetched = await asyncio.gather(*(self.fetchrange(ns_uuid, start, end, max_retries)
+                                                 for start, end in chunks))
+                chunkdata = [data for data, response_url in fetched]
+                if any(data == "" for data in chunkdata):
+                    return "", ""
+                return mergechunks(chunks, chunkdata), jsonurl(ns_uuid, startDate, endDate)
+            return await self.fetchrange(ns_uuid, startDate, endDate, max_retries)
+
+    # Obtain the data of one request, retried as the policy allows
+    async def fetchrange(self, ns_uuid, startDate, endDate, max_retries=10):
+
+        url = jsonurl(ns_uuid, startDate, endDate)  # credentials are part of the url
+        site = siteurl(ns_uuid)
+        deadline = self.policy.deadline()
+        delay = 3  # initial delay in seconds
+        for attempt in range(max_retries):
+            if not self.policy.allow(site):
+                print(f"Skipping {url}: {site} keeps failing.")
+                runreport.count("requests skipped")
+                return "", ""
+            try:
+                with runreport.stage("host limit wait"):
+                    await self.limiter.wait(site)
+                async with self.slots.slot() as slot:
+                    runreport.count("requests")
+                    started = time.perf_counter()
+                    async with self.session.get(url) as response:
+                        slot.answered()
+                        runreport.record("http wait", time.perf_counter() - started)
+                        response.raise_for_status()
+                        # Downloading and decoding alternate, the time spent in the parser is decoding
+                        parser = ReadingsParser()
+                        started, decoding = time.perf_counter(), 0.0
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            runreport.count("bytes downloaded", len(chunk))
+                            fed = time.perf_counter()
+                            parser.feed(chunk)
+                            decoding += time.perf_counter() - fed
+                        runreport.record("download", time.perf_counter() - started - decoding)
+                        runreport.record("json decode", decoding)
+                with runreport.stage("sort"):
+                    data = parser.finish()  # only sorts when the server did not
+                self.policy.success(site)
+                return data, str(response.url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                wait = None if self.policy.failure(site, e) else self.policy.backoff(delay, deadline)
+                if attempt < max_retries - 1 and wait is not None:
+                    print(f"Attempt {attempt + 1} on {url} failed: {e}. Retrying in {wait:g} seconds...")
+                    runreport.count("retries")
+                    with runreport.stage("backoff"):
+                        await asyncio.sleep(wait)
+                    delay *= 2  # Exponential backoff
+                else:
+                    print(f"Attempt {attempt + 1} on {url} failed: {e}. No more retries.")
+                    runreport.count("requests failed")
+                    return "", ""
+            except BaseException:
+                self.policy.abandon(site)
+                raise
+
+    # Obtain data through the on-disk cache, same return values as nscache.cachedretrieve
+    async def cachedretrieve(self, ns_uuid, startDate, endDate, refresh=0):
+        if not ns_uuid:
+            return "", ""
+        if not nscache.cachedir:
+            return await self.dataretrieve(ns_uuid, startDate, endDate)
+
+        index = nscache.loadindex(ns_uuid)
+        days = nscache.daysbetween(startDate, endDate)
+        for run in nscache.dayruns(nscache.missingdays(index, days, refresh)):
+            data, response_url = await self.dataretrieve(ns_uuid, *nscache.runrange(run))
+            if data == "":
+                return "", ""
+            # Other ranges of this patient may have been stored while waiting, so store into a fresh index
+            nscache.storerun(ns_uuid, nscache.loadindex(ns_uuid), run, data)
+
+        return nscache.loadcached(ns_uuid, startDate, endDate)
+
+    # Obtain all windows of one patient, see data_via_nsuuid.planretrieve
+    async def planretrieve(self, ns_uuid, windows, maxgap=1, refresh=0):
+        ranges = mergewindows(windows, maxgap)
+        fetched = await asyncio.gather(*(self.cachedretrieve(ns_uuid, start, end, refresh) for start, end in ranges))
+        return slicewindows(windows, ranges, [data for data, response_url in fetched])
+
+
+async def cohortretrieve(rows, windowfn, computefn, onresult, nsfn, extrafn, maxinflight, hostrate, workers, refresh):
+    loop = asyncio.get_running_loop()
+    patients = asyncio.Semaphore(maxinflight)  # bound the data held in memory waiting for the pool
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        async with AsyncRetriever(maxinflight, hostrate) as retriever:
+            async def process(row):
+                async with patients:
+                    windowdata = await retriever.planretrieve(nsfn(row), windowfn(row), refresh=refresh)
+                    extra = extrafn(row) if extrafn else {}
+                    # Stage timings of the worker come back with its result
+                    return row, runreport.untimed(await loop.run_in_executor(
+                        pool, partial(runreport.timed, computefn, row, windowdata=windowdata, **extra)))
+
+            for task in asyncio.as_completed([process(row) for row in rows]):
+                try:
+                    onresult(*await task)
+                except Exception as e:
+                    print(f"Error processing row: {e}")
+
+
+# Run a whole cohort: asynchronous retrieval, stats in a small process pool
+def runcohort(rows, windowfn, computefn, onresult, nsfn, extrafn=None, maxinflight=32, hostrate=5, workers=2,
+              refresh=0):
+    """
+    :param rows: list of snapshot rows
+    :param windowfn: function(row) -> list of (startDate, endDate) windows to retrieve
+    :param computefn: picklable function(row, windowdata=...) -> result, run in the process pool
+    :param onresult: function(row, result) called in completion order
+    :param nsfn: function(row) -> ns_uuid
+    :param extrafn: function(row) -> dict of extra keyword arguments for computefn
+    :param maxinflight: int, requests (and patients) in flight at once
+    :param hostrate: float, requests per second per host
+    :param workers: int, processes computing stats
+    :param refresh: int, see nscache.cachedretrieve
+    """
+    asyncio.run(cohortretrieve(rows, windowfn, computefn, onresult, nsfn, extrafn, maxinflight, hostrate, workers,
+                               refresh))
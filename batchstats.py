@@ -0,0 +1,124 @@
+"""
+This module computes the GMIstats metrics for many windows of many patients at once.
+
+The readings of all windows are concatenated into one pair of columns with the offset of every window. Every metric is
+then a segmented reduction (np.add.reduceat at the window offsets), so a whole cohort costs a handful of
+NumPy passes instead of one GMIstats call per window. Thresholds can be changed per call to explore other definitions.
+"""
+import numpy as np
+from sugarstats import cgmtype, GMI
+
+# Glucose thresholds (mg/dL) and fluctuation rates (mg/dL per 5 minutes) of the metrics
+THRESHOLDS = {
+    "verylow": 54.047,
+    "low": 70.261,
+    "high": 180.156,
+    "veryhigh": 250.417,
+    "fluc": 6,
+    "rapid": 11,
+}
+
+
+class Segments:
+    """
+    Glucose readings of many windows in one pair of columns.
+
+    :param sgv: array of glucose values, date sorted within each window
+    :param dates: array of epoch ms dates
+    :param lengths: array of readings per window
+    :param totals: array of entries per window used for percentdata (including entries without sgv)
+    :param cgm: list of "libre" or "dexcom" per window
+    """
+
+    def __init__(self, sgv, dates, lengths, totals, cgm):
+        self.sgv = sgv
+        self.dates = dates
+        self.lengths = lengths
+        self.totals = totals
+        self.cgm = cgm
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    @classmethod
+    def fromreadings(cls, windows):
+        """
+        :param windows: list of Readings, one per window
+        """
+        glucose = [data.glucose() if len(data) else (np.empty(0, np.int16), np.empty(0, np.int64)) for data in windows]
+        return cls(np.concatenate([sgv for sgv, dates in glucose]) if glucose else np.empty(0, np.int16),
+                   np.concatenate([dates for sgv, dates in glucose]) if glucose else np.empty(0, np.int64),
+                   np.array([len(sgv) for sgv, dates in glucose], dtype=np.int64),
+                   np.array([len(data) for data in windows], dtype=np.int64),
+                   [cgmtype(data.devicename(0)) if len(data) else "dexcom" for data in windows])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # Sum of the values (or count of True values) per window
+    def sum(self, values, dtype=np.int32):
+        sums = np.zeros(len(self), dtype=dtype)
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(values, self.offsets[:-1][nonempty], dtype=dtype)
+        return sums
+
+
+def batchstats(segments, days=90, thresholds=None):
+    """
+    :param segments: Segments, or a list of Readings
+    :param days: int or array of window lengths in days
+    :param thresholds: dict overriding some of THRESHOLDS
+    :return: list with the 15 GMIstats metrics per window, or None for windows without enough readings
+    """
+    if not isinstance(segments, Segments):
+        segments = Segments.fromreadings(segments)
+    limits = {**THRESHOLDS, **(thresholds or {})}
+    sgv = segments.sgv
+    days = np.asarray(days)
+    count = segments.lengths
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Percent data based on cgm brand
+        perday = np.where(np.array(segments.cgm) == "libre", 96, 288)
+        percentdata = segments.totals / (perday * days) * 100
+
+        # Average glucose, standard deviation and GMI, from sums of integers that are exact in float64
+        values = sgv.astype(np.float64)
+        total = segments.sum(values, np.float64)
+        avgglucose = total / count
+        std = np.sqrt(np.maximum(segments.sum(values * values, np.float64) / count - avgglucose * avgglucose, 0))
+
+        # Readings beyond each threshold
+        below54 = segments.sum(sgv < limits["verylow"])
+        below70 = segments.sum(sgv < limits["low"])
+        above180 = segments.sum(sgv > limits["high"])
+        above250 = segments.sum(sgv > limits["veryhigh"])
+
+        # Pairs of consecutive readings of the same window at most 6 minutes apart, stored at the first reading
+        timedelta = np.diff(segments.dates)
+        delta = np.abs(np.diff(sgv.astype(np.int32))) * (1000 * 60 * 5)
+        valid = np.zeros(len(sgv), dtype=bool)
+        valid[:-1] = (timedelta > 0) & (timedelta <= 6 * 60 * 1000)
+        valid[segments.offsets[1:][count > 0] - 1] = False
+        events = segments.sum(valid)
+        fluc = np.zeros(len(sgv), dtype=bool)
+        fluc[:-1] = delta >= limits["fluc"] * timedelta  # rate in mg/dL per 5 minutes
+        timefluc = segments.sum(valid & fluc) / events * 100
+        fluc[:-1] = delta >= limits["rapid"] * timedelta
+        timerapid = segments.sum(valid & fluc) / events * 100
+
+        # TBR, TAR, TIR, very lows, etc.
+        TBR = below70 / count * 100
+        TAR = above180 / count * 100
+        TIR = 100 - TAR - TBR
+        verylow = below54 / count * 100
+        low = (below70 - below54) / count * 100
+        high = (above180 - above250) / count * 100
+        veryhigh = above250 / count * 100
+
+    # Same windows as GMIstats fails on: no readings, or no pairs of readings for the fluctuation
+    ok = (count > 0) & (events > 0)
+    columns = [percentdata, avgglucose, std, GMI(avgglucose), TBR, TIR, TAR, verylow, low, high, veryhigh,
+               timefluc, timerapid]
+    rows = zip(*(column.tolist() for column in columns))
+    return [(cgm, length, *row) if good else None
+            for cgm, length, good, row in zip(segments.cgm, count.tolist(), ok.tolist(), rows)]
@@ -0,0 +1,294 @@
+"""
+This script benchmarks loopstats, a1cgmi and zucara end to end against the nssim stand-in nightscout sites.
+
+Every tool runs on synthetic cohorts of increasing size in its own working directory, in a child process so its
+memory and CPU (with those of its worker processes) can be measured. Each run has two stages: "cold" starts from an
+empty data cache, so it retrieves everything, and "warm" runs again on the filled cache. Per stage the harness
+reports wall time, throughput in patients per second, the p50 and p99 of the time each patient's requests took
+(first request sent to last answer, as seen by the server), peak RSS and CPU seconds. The simulator runs in a process
+of its own, and peak RSS is sampled over the tool's whole process tree (the proportional set sizes of the tool and its
+workers summed), so neither the harness nor the simulator is counted. When the tool writes a run report (loopstats), the time per pipeline stage
+(requests, decoding, stats, writes, ...) summed over its workers is reported with each cold or warm stage.
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from datetime import date, timedelta
+import numpy as np
+import nssim
+
+TOOLS = ["loopstats", "a1cgmi", "zucara"]
+STAGES = ["cold", "warm"]
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def writecsv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+# Input files the tool reads, for a cohort of ns_uuids, in workdir
+def writecohort(tool, uuids, workdir):
+    folder = os.path.join(workdir, "gitignore")
+    os.makedirs(folder, exist_ok=True)
+    today = date.today()
+    if tool == "loopstats":
+        # Loop start dates leaving room for the last 360-day window before today
+        writecsv(os.path.join(folder, "working.csv"), ["key", "link", "ns_uuid", "OSAID startdate", "Software"],
+                 [[i + 1, f"https://example.invalid/?patient_id={i + 1}", ns_uuid,
+                   (today - timedelta(370 + i % 200)).isoformat(), "Loop"] for i, ns_uuid in enumerate(uuids)])
+    elif tool == "a1cgmi":
+        header = ["DPD_ID", "link", "ns_uuid", "A1c", "A1c_datetime", "A1c_previous", "A1c_previous_datetime",
+                  "A1c_3d_most_recent", "A1c_3d_most_recent_datetime"]
+        rows = []
+        for i, ns_uuid in enumerate(uuids):
+            latest = today - timedelta(1 + i % 60)
+            rows.append([i + 1, f"https://example.invalid/?patient_id={i + 1}", ns_uuid,
+                         7.1, latest.isoformat(), 7.4, (latest - timedelta(120)).isoformat(),
+                         6.9, (latest - timedelta(240)).isoformat()])
+        writecsv(os.path.join(folder, "DPD 2024-10-30.csv"), header, rows)
+    elif tool == "zucara":
+        writecsv(os.path.join(folder, "snapshot20250116.csv"),
+                 ["link", "AAPS_AID_y", "AAPS_date_start", "Loop_AID_y", "LOOP_date_start", "iAPS_AID_y",
+                  "iAPS_date_start"],
+                 [[f"https://example.invalid/?patient_id={i + 1}", 0, "", 1,
+                   (today - timedelta(100 + i % 300)).isoformat(), 0, ""] for i in range(len(uuids))])
+        writecsv(os.path.join(folder, "osaid.csv"), ["key", "ns_uuid", "ns_status"],
+                 [[i + 1, ns_uuid, 1] for i, ns_uuid in enumerate(uuids)])
+    else:
+        raise ValueError(f"unknown tool {tool}")
+
+# Run one tool in the current directory (the child process)
+def runtool(tool, mode):
+    if tool == "loopstats":
+        from loopstats import loopstats
+        loopstats("gitignore/working.csv", "bench", mode=mode, incremental=False)
+    elif tool == "a1cgmi":
+        from a1cgmi import a1cgmi
+        a1cgmi(90, mode=mode, incremental=False)
+    elif tool == "zucara":
+        import zucara
+        zucara.main()
+    else:
+        raise ValueError(f"unknown tool {tool}")
+
+# Field of /proc/<pid>/<name> in bytes, None when it cannot be read
+def procstatus(pid, field, name="status"):
+    try:
+        with open(f"/proc/{pid}/{name}") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# Memory (bytes) of a process and all its descendants, None without /proc. Forked workers share pages with their
+# parent, so the proportional set size (shared pages split between their users) is summed, or RSS without it.
+def treerss(pid):
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        total += procstatus(pid, "Pss", "smaps_rollup") or procstatus(pid, "VmRSS") or 0
+        pending.extend(children.get(pid, []))
+    return total
+
+class TreeSampler(threading.Thread):
+    """Highest summed RSS of this process and its workers, sampled every `interval` seconds."""
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, treerss(os.getpid()) or 0)
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return self.peak
+
+# Peak RSS (bytes) of this process tree and CPU seconds of this process and its finished children
+def usage(sampled):
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = max(sampled, procstatus("self", "VmHWM") or 0)
+    if not peak:
+        # No /proc (macOS): this process only, ru_maxrss is in bytes there
+        peak = own.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {"peakrss": peak, "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime}
+
+def child(tool, mode, report):
+    sampler = TreeSampler()
+    sampler.start()
+    runtool(tool, mode)
+    sampled = sampler.stop()
+    with open(report, "w") as f:
+        json.dump(usage(sampled), f)
+
+
+class SimulatorProcess:
+    """
+    nssim.Simulator in a process of its own, used as `with SimulatorProcess(...) as simulator:`.
+
+    :param simulation: keyword arguments for the nssim command line (latency, errors, dead, gaps, seed, ...)
+    """
+
+    def __init__(self, **simulation):
+        self.simulation = simulation
+
+    def __enter__(self):
+        command = [sys.executable, os.path.join(REPO, "nssim.py"), "--port", "0"]
+        for key, value in self.simulation.items():
+            command += [f"--{key}", str(value)]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        if "NSURL=" not in line:
+            self.process.kill()
+            raise RuntimeError(f"the simulator did not start: {line!r}")
+        self.url = line.split("NSURL=", 1)[1].strip()
+        self.base = self.url.rsplit("/", 1)[0]
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+    # Request log entries from `since` on, as nssim.Simulator.log
+    def log(self, since=0):
+        with urllib.request.urlopen(f"{self.base}/_log?since={since}") as response:
+            return json.load(response)
+
+# Per patient time from the first request sent to the last answer, in seconds
+def patientlatency(log, since):
+    spans = {}
+    for ns_uuid, kind, started, finished, status, size in log:
+        if started >= since:
+            first, last = spans.get(ns_uuid, (started, finished))
+            spans[ns_uuid] = (min(first, started), max(last, finished))
+    return np.array([last - first for first, last in spans.values()])
+
+def runstage(simulator, tool, mode, size, workdir, stage, quiet=True):
+    report = os.path.abspath(os.path.join(workdir, f"usage_{stage}.json"))
+    env = {**os.environ, "NSURL": simulator.url, "PYTHONPATH": os.pathsep.join(filter(None, [REPO, os.environ.get(
+        "PYTHONPATH")]))}
+    logged = len(simulator.log())
+    stagereport = os.path.join(workdir, "gitignore", "report_bench_-.json")  # written by loopstats
+    if os.path.exists(stagereport):
+        os.remove(stagereport)
+    since = time.monotonic()
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO, "bench.py"), "--child", tool, "--mode", mode,
+                    "--report", report], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.DEVNULL if quiet else None)
+    wall = time.perf_counter() - started
+    with open(report) as f:
+        measured = json.load(f)
+
+    requests = simulator.log(logged)
+    latency = patientlatency(requests, since)
+    stagetimes = {}
+    if os.path.exists(stagereport):
+        with open(stagereport) as f:
+            stagetimes = {name: stats["total"] for name, stats in json.load(f)["stages"].items()}
+    return {
+        "tool": tool, "mode": mode, "patients": size, "stage": stage,
+        "wall": wall,
+        "throughput": size / wall,
+        "latency_p50": float(np.percentile(latency, 50)) if len(latency) else None,
+        "latency_p99": float(np.percentile(latency, 99)) if len(latency) else None,
+        "requests": len(requests),
+        "failed": sum(1 for request in requests if request[4] != 200),
+        "peakrss_mb": measured["peakrss"] / 1024 ** 2,
+        "cpu": measured["cpu"],
+        "stagetimes": stagetimes,  # seconds per pipeline stage, summed over worker processes
+    }
+
+def bench(tools=TOOLS, sizes=(10, 100, 1000, 10000), mode="process", root="gitignore/bench", output=None,
+          quiet=True, **simulation):
+    """
+    :param tools: list of TOOLS entries
+    :param sizes: cohort sizes
+    :param mode: str, retrieval mode of loopstats and a1cgmi ("process" or "async")
+    :param root: str, folder of the working directories, emptied per run
+    :param output: str, JSON file the results are written to
+    :param simulation: keyword arguments for the nssim command line (latency, errors, dead, gaps, duplicates, ...)
+    :return: list of result dicts, one per tool, size and stage
+    """
+    results = []
+    with SimulatorProcess(**simulation) as simulator:
+        for tool in tools:
+            for size in sizes:
+                workdir = os.path.join(root, f"{tool}_{size}")
+                shutil.rmtree(workdir, ignore_errors=True)
+                writecohort(tool, nssim.cohort(size, simulation.get("seed", 0)), workdir)
+                for stage in STAGES:
+                    result = runstage(simulator, tool, mode, size, workdir, stage, quiet)
+                    results.append(result)
+                    print(describe(result))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+def describe(result):
+    latency = ("-" if result["latency_p50"] is None else
+               f"{result['latency_p50']:.2f}/{result['latency_p99']:.2f}s")
+    return (f"{result['tool']:>9} {result['patients']:>6} {result['stage']:>4}: {result['wall']:8.1f}s "
+            f"{result['throughput']:8.2f} patients/s  latency p50/p99 {latency}  {result['requests']} requests "
+            f"({result['failed']} failed)  peak RSS {result['peakrss_mb']:.0f} MB  CPU {result['cpu']:.1f}s"
+            + "".join(f"\n{'':>26}{name}: {seconds:.2f}s" for name, seconds in list(result["stagetimes"].items())[:5]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scripts end to end against simulated nightscout sites")
+    parser.add_argument("--tools", nargs="+", choices=TOOLS, default=TOOLS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000], help="cohort sizes")
+    parser.add_argument("--mode", choices=["process", "async"], default="process",
+                        help="retrieval mode of loopstats and a1cgmi")
+    parser.add_argument("--root", default="gitignore/bench", help="folder of the working directories")
+    parser.add_argument("--output", default="gitignore/bench.json", help="JSON file of the results")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the scripts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds of latency, up to this")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of requests answered 503")
+    parser.add_argument("--dead", type=float, default=0.0, help="share of sites answering 404")
+    parser.add_argument("--gaps", type=float, default=0.0, help="share of days with a sensor gap")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="share of readings uploaded twice")
+    parser.add_argument("--libreminutes", type=int, default=5, help="minutes between Libre readings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=TOOLS, help=argparse.SUPPRESS)
+    parser.add_argument("--report", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.mode, args.report)
+    else:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        bench(args.tools, args.sizes, args.mode, args.root, args.output, quiet=not args.verbose,
+              latency=args.latency, jitter=args.jitter, errors=args.errors, dead=args.dead, gaps=args.gaps,
+              duplicates=args.duplicates, libreminutes=args.libreminutes, seed=args.seed)
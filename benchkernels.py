@@ -0,0 +1,302 @@
+"""
+This script times the stats kernels on synthetic readings and guards them against regressions.
+
+Every kernel is timed in the style of pytest-benchmark on nssim traces of 1 day to 2 years: calls are repeated until a
+round takes long enough, and the best and median of a few rounds are kept, with the best also given per 10k readings.
+Results are saved as JSON baselines. --compare times the kernels again and flags those slower than the baseline by
+more than a threshold (exit status 1), so a change can be gated on it. --check proves every kernel equivalent to the
+version it replaced (kept below as references, from before the kernels were vectorized) and reports the speedup.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+import numpy as np
+import pytz
+import nssim
+from readings import Readings
+import sugarstats
+from sugarstats import cgmtype, dataPercent, GMI, timeinfluc
+from data_via_nsuuid import sugarreadings
+import timefilter
+import zucara
+import loopstats
+import a1cgmi
+
+DAYS = [1, 7, 30, 90, 365, 730]
+CHECKDAYS = [1, 30, 90, 365]  # the references take seconds on longer traces
+STARTMS = 1704067200000  # 2024-01-01 UTC
+TIMEZONE = "America/Vancouver"
+
+
+class Sample:
+    """
+    Synthetic readings of one Dexcom patient over a number of days, as Readings and as nightscout entries.
+
+    :param days: int
+    :param seed: int, see nssim.Patient
+    """
+
+    def __init__(self, days, seed=0):
+        patient = nssim.Patient("kernels", seed, libre=0, gaps=0.05, duplicates=0.01)
+        dates, sgv = patient.readings(STARTMS, STARTMS + days * nssim.DAYMS - 1)
+        self.days = days
+        self.data = Readings(dates[::-1], sgv[::-1], np.zeros(len(dates)), [patient.device])
+        strings = np.datetime_as_string(self.data.date.astype("datetime64[ms]"))
+        self.entries = [{"date": date, "sgv": value, "device": patient.device, "dateString": f"{string}Z"}
+                        for date, value, string in zip(self.data.date.tolist(), self.data.sgv.tolist(),
+                                                       strings.tolist())]
+
+    def __len__(self):
+        return len(self.data)
+
+
+# References: the kernels as they were before they were vectorized, on lists of nightscout entries
+
+def refGMIstats(data, days=90):
+    try:
+        retrievedevice = data[0]['device']
+    except:
+        retrievedevice = ""
+    cgm = cgmtype(retrievedevice)
+    percentdata = dataPercent(data, cgm, days)
+    sgv_values, sgv_valuesdt = sugarreadings(data)
+    count = len(sgv_values)
+    timefluc = timeinfluc(sgv_valuesdt)
+    timerapid = timeinfluc(sgv_valuesdt, True)
+    avgglucose = sum(sgv_values) / len(sgv_values)
+    std = np.std(sgv_values)
+    ptGMI = GMI(avgglucose)
+    TBR = (sum(i < 70.261 for i in sgv_values))/count*100
+    TAR = (sum(i > 180.156 for i in sgv_values))/count*100
+    TIR = 100 - TAR - TBR
+    verylow = (sum(i < 54.047 for i in sgv_values))/count*100
+    low = (sum(54.047 <= i < 70.261 for i in sgv_values)) / count * 100
+    high = (sum(180.156 < i <= 250.417 for i in sgv_values)) / count * 100
+    veryhigh = (sum(i > 250.417 for i in sgv_values))/count*100
+    return (cgm, count, percentdata, avgglucose, std, ptGMI, TBR, TIR, TAR,
+            verylow, low, high, veryhigh, timefluc, timerapid)
+
+def reftbrcalc(data, threshold, brand):
+    totalcount = 0
+    datecount = {}
+    all_values = []
+    for key, item in data.items():
+        data_sorted = sorted(item, key=lambda x: x["dateString"])
+        deduped = []
+        last_timestamp = None
+        for entry in data_sorted:
+            current_ts = np.datetime64(entry["dateString"].rstrip("Z"), "ms")
+            if last_timestamp is None:
+                deduped.append(entry)
+                last_timestamp = current_ts
+            elif current_ts - last_timestamp >= np.timedelta64(3, "m"):
+                deduped.append(entry)
+                last_timestamp = current_ts
+        values = np.array([d["sgv"] for d in deduped if "sgv" in d])
+        all_values += values.tolist()
+        runlength = 2 if brand == "libre" else 3
+        count = 0
+        current_run_length = 0
+        for b in values < threshold:
+            if b:
+                current_run_length += 1
+            else:
+                if current_run_length >= runlength:
+                    count += 1
+                current_run_length = 0
+        if current_run_length >= runlength:
+            count += 1
+        totalcount += count
+        datecount[key] = count
+    return totalcount, all_values, datecount
+
+def reffilterbytime(data, starttime, endtime):
+    dates_full = np.array([d["dateString"].rstrip("Z") for d in data], dtype="datetime64[ms]")
+    dates_only = dates_full.astype("datetime64[D]")
+    time_of_day = dates_full - dates_only
+    time_mask = (time_of_day >= np.timedelta64(starttime, "h")) & (time_of_day < np.timedelta64(endtime, "h"))
+    filtered = np.array(data, dtype=object)[time_mask]
+    filtered_dates_full = dates_only[time_mask]
+    return {str(day): filtered[filtered_dates_full == day].tolist() for day in np.unique(filtered_dates_full)}
+
+def reffilter_by_time_np(data, start_time, end_time, tz="UTC"):
+    zone = pytz.timezone(tz)
+    start = timefilter.minutes(start_time) * timefilter.MINUTEMS
+    end = timefilter.minutes(end_time) * timefilter.MINUTEMS
+    filtered = []
+    for entry in data:
+        local = datetime.fromtimestamp(entry["date"] / 1000, zone)
+        time_of_day = (local.hour * 3600 + local.minute * 60 + local.second) * 1000 + local.microsecond // 1000
+        if (start <= time_of_day <= end) if start <= end else (time_of_day >= start or time_of_day <= end):
+            filtered.append(entry)
+    return filtered
+
+def refdaily_avg_blood_sugar(daily_data, ptID):
+    daily_sgv = defaultdict(list)
+    for entry in daily_data:
+        if 'sgv' in entry:
+            date = datetime.fromtimestamp(entry['date'] / 1000).strftime('%Y-%m-%d')
+            daily_sgv[date].append(entry['sgv'])
+    return [(ptID, date, sum(sgv_list) / len(sgv_list), len(sgv_list)) for date, sgv_list in daily_sgv.items()]
+
+
+# Equal results, floats within rounding
+def same(a, b):
+    if isinstance(a, Readings):
+        a = a.date.tolist()
+    if isinstance(a, dict):
+        return isinstance(b, dict) and list(a) == list(b) and all(same(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)):
+        if len(a) and len(b) and isinstance(b, list) and isinstance(b[0], dict) and not isinstance(a[0], dict):
+            b = [entry["date"] for entry in b]
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, (float, np.floating)) or isinstance(b, (float, np.floating)):
+        return bool(np.isclose(a, b, rtol=1e-9, atol=1e-9))
+    return a == b
+
+
+# Kernel name -> (current kernel and its arguments, reference and its arguments) for a Sample
+KERNELS = {
+    "GMIstats": (
+        lambda sample: (sugarstats.GMIstats, (sample.data, sample.days)),
+        lambda sample: (refGMIstats, (sample.entries, sample.days)),
+    ),
+    "timeinfluc": (
+        lambda sample: (sugarstats.timeinflucnp, sample.data.glucose()),
+        lambda sample: (lambda valdt: (timeinfluc(valdt), timeinfluc(valdt, True)),
+                        (sugarreadings(sample.entries)[1],)),
+    ),
+    "tbrcalc": (
+        lambda sample: (zucara.tbrcalc, (zucara.filterbytime(sample.data, 7, 13), 63, "dexcom")),
+        lambda sample: (reftbrcalc, (reffilterbytime(sample.entries, 7, 13), 63, "dexcom")),
+    ),
+    "filterbytime": (
+        lambda sample: (zucara.filterbytime, (sample.data, 7, 13)),
+        lambda sample: (reffilterbytime, (sample.entries, 7, 13)),
+    ),
+    "filter_by_time_np": (
+        lambda sample: (loopstats.filter_by_time_np, (sample.data, "22:00", "06:00", TIMEZONE)),
+        lambda sample: (reffilter_by_time_np, (sample.entries, "22:00", "06:00", TIMEZONE)),
+    ),
+    "daily_avg_blood_sugar": (
+        lambda sample: (a1cgmi.daily_avg_blood_sugar, (sample.data, 1)),
+        lambda sample: (refdaily_avg_blood_sugar, (sample.entries, 1)),
+    ),
+}
+
+
+def timecall(fn, args, rounds=5, mintime=0.05):
+    """
+    :param rounds: int, rounds timed
+    :param mintime: float, seconds a round takes at least, calls are repeated until it does
+    :return: (best, median) seconds per call
+    """
+    with contextlib.redirect_stdout(io.StringIO()):  # tbrcalc prints its counts
+        number = 1
+        while True:
+            started = time.perf_counter()
+            for _ in range(number):
+                fn(*args)
+            elapsed = time.perf_counter() - started
+            if elapsed >= mintime:
+                break
+            number *= 2 if elapsed < mintime / 10 else max(2, int(mintime / max(elapsed, 1e-9) + 1))
+        times = [elapsed / number]
+        for _ in range(rounds - 1):
+            started = time.perf_counter()
+            for _ in range(number):
+                fn(*args)
+            times.append((time.perf_counter() - started) / number)
+    return min(times), statistics.median(times)
+
+def benchmark(kernels=None, days=DAYS, rounds=5):
+    """
+    :return: dict, kernel -> days -> {"readings", "best", "median", "per10k"} in seconds
+    """
+    results = {}
+    for length in days:
+        sample = Sample(length)
+        for name in kernels or KERNELS:
+            fn, args = KERNELS[name][0](sample)
+            best, median = timecall(fn, args, rounds)
+            results.setdefault(name, {})[str(length)] = {"readings": len(sample), "best": best, "median": median,
+                                                         "per10k": best / len(sample) * 10000}
+            print(f"{name:>22} {length:>4} days {len(sample):>7} readings: {best * 1000:10.3f} ms "
+                  f"(median {median * 1000:.3f} ms, {best / len(sample) * 1e7:.3f} ms per 10k)")
+    return results
+
+def save(results, path):
+    meta = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "date": datetime.now().isoformat(timespec="seconds")}
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+def compare(results, path, threshold=0.25):
+    """
+    :param threshold: float, allowed slowdown of the best time over the baseline, 0.25 for 25%
+    :return: list of (kernel, days, ratio) slower than allowed
+    """
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    slower = []
+    for name, lengths in results.items():
+        for length, result in lengths.items():
+            before = baseline.get(name, {}).get(length)
+            if not before:
+                continue
+            ratio = result["best"] / before["best"]
+            flag = "SLOWER" if ratio > 1 + threshold else ""
+            print(f"{name:>22} {length:>4} days: {before['best'] * 1000:10.3f} -> {result['best'] * 1000:10.3f} ms "
+                  f"({ratio:.2f}x) {flag}")
+            if flag:
+                slower.append((name, length, ratio))
+    return slower
+
+def check(kernels=None, days=CHECKDAYS, rounds=3):
+    """
+    Run every kernel against its reference.
+
+    :return: list of (kernel, days, problem) where they disagree or the kernel is slower
+    """
+    problems = []
+    for length in days:
+        sample = Sample(length)
+        for name in kernels or KERNELS:
+            current, reference = KERNELS[name][0](sample), KERNELS[name][1](sample)
+            with contextlib.redirect_stdout(io.StringIO()):
+                equal = same(current[0](*current[1]), reference[0](*reference[1]))
+            new, old = timecall(*current, rounds)[0], timecall(*reference, rounds)[0]
+            print(f"{name:>22} {length:>4} days: {'equal' if equal else 'DIFFERENT':>9}, "
+                  f"{old * 1000:10.3f} -> {new * 1000:10.3f} ms ({old / new:.1f}x faster)")
+            if not equal:
+                problems.append((name, length, "different"))
+            elif new > old:
+                problems.append((name, length, "slower"))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the stats kernels, compare them to a baseline or a reference")
+    parser.add_argument("--kernels", nargs="+", choices=list(KERNELS), help="kernels to run, all by default")
+    parser.add_argument("--days", nargs="+", type=int, help="lengths of the synthetic traces in days")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--save", help="JSON file to store the results in as a baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown over the baseline (0.25 = 25%%)")
+    parser.add_argument("--check", action="store_true", help="check the kernels against their references instead")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if check(args.kernels, args.days or CHECKDAYS) else 0)
+    results = benchmark(args.kernels, args.days or DAYS, args.rounds)
+    if args.save:
+        save(results, args.save)
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare, args.threshold) else 0)
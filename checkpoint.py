@@ -0,0 +1,66 @@
+"""
+This module records finished patients of a cohort run so that an interrupted run can be resumed.
+
+Every patient's output is appended to the checkpoint file and synced to disk as soon as it is done. Resuming reads the
+file back and skips those patients.
+"""
+import csv
+import json
+import os
+
+csv.field_size_limit(2 ** 31 - 1)  # daily series of one patient can be long
+
+
+class Checkpoint:
+    """
+    :param path: str, checkpoint CSV file
+    :param resume: bool, keep the patients of an earlier run instead of starting over
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()  # keys of the patients finished before this run
+
+        if resume and os.path.exists(path):
+            # Copy the intact entries to a fresh file, dropping a line cut off when the run died
+            with open(path, newline='') as old, open(f"{path}.tmp", 'w', newline='') as new:
+                writer = csv.writer(new)
+                for entry in csv.reader(old):
+                    try:
+                        key, output = entry
+                        json.loads(output)
+                    except ValueError:
+                        continue
+                    self.done.add(key)
+                    writer.writerow(entry)
+            os.replace(f"{path}.tmp", path)
+
+        self.file = open(path, 'a' if self.done else 'w', newline='')
+        self.writer = csv.writer(self.file)
+
+    # Outputs of the patients finished before this run, read back one at a time
+    def outputs(self):
+        with open(self.path, newline='') as f:
+            for key, output in csv.reader(f):
+                if key in self.done:
+                    yield json.loads(output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def put(self, key, output):
+        self.writer.writerow([key, json.dumps(output)])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Remove the checkpoint once the run's output has been written
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+def patientkey(row, ptIDCol, ptNSCol):
+    return f"{row[ptIDCol]}|{row[ptNSCol]}"
@@ -1,16 +1,29 @@
 """
 This module takes NS_UUIDs, a start and end date, and retrieves their data
 """
+import json
+import os
 import requests
+from multiprocessing import util
+import retrypolicy
+import runreport
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import time
 import pytz
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from readings import Readings, ReadingsParser
+
+# Site of a patient's nightscout, {ns_uuid} is filled in. Set NSURL (e.g. to the nssim base url) to use another server.
+nsurl = os.environ.get("NSURL", "https://{ns_uuid}.cgm.bcdiabetes.ca")
+
+def siteurl(ns_uuid):
+    return nsurl.format(ns_uuid=ns_uuid)
 
 # Create URL from ns_uuid
 def jsonurl(ns_uuid, startDate, endDate):
-    base_url = f"https://_cgm:queries_@{ns_uuid}.cgm.bcdiabetes.ca/get-glucose-data"
+    base_url = f"{siteurl(ns_uuid).replace('://', '://_cgm:queries_@', 1)}/get-glucose-data"
     params = {
         "gte": f"{startDate}Z",
         "lte": f"{endDate}Z"
@@ -35,49 +48,274 @@ def find_timezone(data):
                 return result
     return None  # Return None if not found
 
-# Get timezone - Broken
-def timezone(ns_uuid, endDate):
-    # Define a session with increased retry settings
-    session = requests.Session()
-    retries = Retry(
-        total=3,  # Number of total retries
-        backoff_factor=1,  # Wait time increases exponentially: 1s, 2s, 4s, etc.
-        allowed_methods={"GET", "POST"}  # Retry only for GET and POST requests
-    )
-    # Mount the retry strategy to HTTPS connections
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+# Timezones are cached per ns_uuid, in memory and in a JSON file shared between runs and worker processes
+tzcachefile = "gitignore/timezones.json"  # set to None to keep the cache in memory only
+tzttl = 7 * 24 * 60 * 60  # seconds before a cached timezone is looked up again
+tzcache = None  # {ns_uuid: [timezone, fetched epoch seconds]}
+tzbatch = 200  # new lookups held in memory before they are written to tzcachefile
+tzpending = {}  # {ns_uuid: [timezone, fetched epoch seconds]} not written yet
+tzflusher = None  # pid that registered the flush at process exit
+profilesession = None
+datasession = None
+
+# Shared session with pooled connections and retries for profile requests
+def getprofilesession():
+    global profilesession
+    if profilesession is None:
+        profilesession = requests.Session()
+        retries = Retry(
+            total=3,  # Number of total retries
+            backoff_factor=1,  # Wait time increases exponentially: 1s, 2s, 4s, etc.
+            allowed_methods={"GET", "POST"}  # Retry only for GET and POST requests
+        )
+        # Mount the retry strategy to HTTPS connections
+        profilesession.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=32))
+        profilesession.mount("http://", HTTPAdapter(max_retries=retries, pool_maxsize=32))
+    return profilesession
+
+# Shared session with pooled keep-alive connections for data requests, retries are left to the RetryPolicy
+def getdatasession():
+    global datasession
+    if datasession is None:
+        datasession = requests.Session()
+        datasession.mount("https://", HTTPAdapter(pool_maxsize=32))
+        datasession.mount("http://", HTTPAdapter(pool_maxsize=32))
+    return datasession
+
+def loadtzcache():
+    if not tzcachefile:
+        return {}
+    try:
+        with open(tzcachefile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
+# New lookups are written in batches and when the process (a worker or the main one) exits
+def savetzcache(ns_uuid, entry):
+    global tzflusher
+    if not tzcachefile:
+        return
+    tzpending[ns_uuid] = entry
+    if tzflusher != os.getpid():
+        tzflusher = os.getpid()
+        util.Finalize(None, flushtzcache, exitpriority=10)
+    if len(tzpending) >= tzbatch:
+        flushtzcache()
+
+def flushtzcache():
+    if not tzcachefile or not tzpending:
+        return
+    # Merge with entries written by other processes since this one loaded the file
+    cache = loadtzcache()
+    cache.update(tzpending)
+    tmp = f"{tzcachefile}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, tzcachefile)
+    tzpending.clear()
+
+# Get timezone from the nightscout profile
+def profiletimezone(ns_uuid, endDate):
     #profileurl = f"https://{ns_uuid}.cgm.bcdiabetes.ca/api/v1/profiles?find[startDate][$gte]={startDate}&count=10000000" #ex date 2025-01-08
-    profileurl = f"https://{ns_uuid}.cgm.bcdiabetes.ca/api/v1/profile.json?find[startDate][$lte]={endDate}" #ex date 2025-01-08
-    jsonurl(ns_uuid, "", "")
-    response = session.get(profileurl, timeout=10)
+    profileurl = f"{siteurl(ns_uuid)}/api/v1/profile.json?find[startDate][$lte]={endDate}" #ex date 2025-01-08
+    response = getprofilesession().get(profileurl, timeout=10)
     response.raise_for_status()
     tz = find_timezone(response.json()[0])
+    if not tz:
+        raise ValueError(f"no timezone in the profile of {ns_uuid}")
     return tz
 
+# Timezone cached by an earlier lookup, however old, or None, without requesting the profile
+def cachedtimezone(ns_uuid, endDate=None):
+    global tzcache
+    if tzcache is None:
+        tzcache = loadtzcache()
+    entry = tzcache.get(ns_uuid)
+    return entry[0] if entry else None
+
+# Get timezone, looked up at most once per ns_uuid within tzttl
+def timezone(ns_uuid, endDate):
+    global tzcache
+    if tzcache is None:
+        tzcache = loadtzcache()
+    entry = tzcache.get(ns_uuid)
+    # Profiles without a timezone were cached as None by earlier versions, they are looked up again
+    if entry is None or not entry[0] or time.time() - entry[1] > tzttl:
+        with runreport.stage("timezone"):
+            entry = [profiletimezone(ns_uuid, endDate), time.time()]  # failed lookups raise and are not cached
+            tzcache[ns_uuid] = entry
+            savetzcache(ns_uuid, entry)
+    else:
+        runreport.count("timezone cache hits")
+    return entry[0]
+
+# Long ranges are fetched as chunks of this many days, at most chunkworkers at once (None to never split). The
+# windows of a loopstats patient (about 400 days) take one round of chunks.
+chunkdays = 120
+chunkworkers = 4
+
+# Split a query range into consecutive chunks sharing their boundaries
+def chunkranges(startDate, endDate, days=None):
+    """
+    :param startDate: str, UTC start date ("YYYY-MM-DD" or ISO datetime)
+    :param endDate: str, UTC end date
+    :param days: int, chunk length in days, or None for a single chunk
+    :return: list of (startDate, endDate), each chunk starting where the previous one ends
+    """
+    start, end = datetime.fromisoformat(startDate), datetime.fromisoformat(endDate)
+    if not days or end - start <= timedelta(days):
+        return [(startDate, endDate)]
+    dateformat = (lambda dt: dt.isoformat()) if "T" in startDate else (lambda dt: dt.strftime("%Y-%m-%d"))
+    bounds = [startDate]
+    while datetime.fromisoformat(bounds[-1]) + timedelta(days) < end:
+        bounds.append(dateformat(datetime.fromisoformat(bounds[-1]) + timedelta(days)))
+    bounds.append(endDate)
+    return list(zip(bounds, bounds[1:]))
+
+# Join the date sorted readings of consecutive chunks
+def mergechunks(chunks, chunkdata):
+    # Chunks follow each other, so merging them is joining them in order once the readings a chunk shares with the
+    # previous one (dated exactly on their common boundary) are dropped
+    batches = [chunkdata[0]]
+    for (start, end), data in zip(chunks[1:], chunkdata[1:]):
+        batches.append(data.window(epochms(start) + 1, epochms(end)))
+    return Readings.concat(batches)
+
 # Obtain data
-def dataretrieve(ns_uuid, startDate, endDate, max_retries=10):
+@runreport.stage("dataretrieve")
+def dataretrieve(ns_uuid, startDate, endDate, max_retries=10, stream=True, policy=None, chunk=None):
+    """
+    Ranges longer than `chunk` days are fetched as concurrent chunks, each retried on its own.
+
+    :param stream: bool, parse the response into columns while it downloads instead of decoding the whole body
+    :param policy: RetryPolicy deciding on retries and backoff, the process wide one by default
+    :param chunk: int, days per chunk (0 for a single request), chunkdays by default
+    :return: (date sorted Readings, url) or ("", "") if all attempts failed
+    """
     if not ns_uuid:
         return "", ""
 
+    chunks = chunkranges(startDate, endDate, chunkdays if chunk is None else chunk)
+    if len(chunks) > 1:
+        runreport.count("chunked ranges")
+        with ThreadPoolExecutor(max_workers=chunkworkers) as executor:
+            fetched = list(executor.map(lambda bounds: fetchrange(ns_uuid, *bounds, max_retries, stream, policy),
+                                        chunks))
+        chunkdata = [data for data, response_url in fetched]
+        if any(data == "" for data in chunkdata):
+            return "", ""
+        return mergechunks(chunks, chunkdata), jsonurl(ns_uuid, startDate, endDate)
+    return fetchrange(ns_uuid, startDate, endDate, max_retries, stream, policy)
+
+# Obtain the data of one request, retried as the policy allows
+def fetchrange(ns_uuid, startDate, endDate, max_retries=10, stream=True, policy=None):
+
+    policy = policy or retrypolicy.policy
+    url = jsonurl(ns_uuid, startDate, endDate)
+    site = siteurl(ns_uuid)  # breakers are per site, one host each in production
+    deadline = policy.deadline()
     delay = 3  # initial delay in seconds
     for attempt in range(max_retries):
+        if not policy.allow(site):
+            print(f"Skipping {url}: {site} keeps failing.")
+            runreport.count("requests skipped")
+            return "", ""
         try:
-            url = jsonurl(ns_uuid, startDate, endDate)
             auth = ('_cgm', 'queries_')  # Authentication credentials
-            response = requests.get(url, auth=auth, timeout=(20, 60))
+            runreport.count("requests")
+            with runreport.stage("http wait"):
+                response = getdatasession().get(url, auth=auth, timeout=(20, 60), stream=stream)
             response.raise_for_status()  # Check if the request was successful
-            data = response.json()
-            data = sorted(data, key=lambda d: d['date'])  # sort data from first to last date
+            if stream:
+                # Downloading and decoding alternate, the time spent in the parser is decoding
+                parser = ReadingsParser()
+                started, decoding = time.perf_counter(), 0.0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    runreport.count("bytes downloaded", len(chunk))
+                    fed = time.perf_counter()
+                    parser.feed(chunk)
+                    decoding += time.perf_counter() - fed
+                runreport.record("download", time.perf_counter() - started - decoding)
+                runreport.record("json decode", decoding)
+                with runreport.stage("sort"):
+                    data = parser.finish()  # only sorts when the server did not
+            else:
+                with runreport.stage("download"):
+                    body = response.content
+                runreport.count("bytes downloaded", len(body))
+                with runreport.stage("json decode"):
+                    data = Readings.fromjson(json.loads(body))
+                with runreport.stage("sort"):
+                    data = data.sort()  # sort data from first to last date
+            policy.success(site)
             return data, response.url
-        except requests.exceptions.RequestException as e:
-            if attempt < max_retries - 1:
-                print(f"Attempt {attempt + 1} on {url} failed: {e}. Retrying in {delay} seconds...")
-                time.sleep(delay)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            wait = None if policy.failure(site, e) else policy.backoff(delay, deadline)
+            if attempt < max_retries - 1 and wait is not None:
+                print(f"Attempt {attempt + 1} on {url} failed: {e}. Retrying in {wait:g} seconds...")
+                runreport.count("retries")
+                with runreport.stage("backoff"):
+                    time.sleep(wait)
                 delay *= 2  # Exponential backoff
             else:
                 print(f"Attempt {attempt + 1} on {url} failed: {e}. No more retries.")
+                runreport.count("requests failed")
                 return "", ""
+        except BaseException:
+            policy.abandon(site)
+            raise
+
+# Convert a query date (UTC, "YYYY-MM-DD" or ISO datetime) to epoch milliseconds
+def epochms(datestr):
+    dt = datetime.fromisoformat(datestr)
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return int(dt.timestamp() * 1000)
+
+# Merge overlapping or neighbouring windows into the ranges that need fetching
+def mergewindows(windows, maxgap=1):
+    """
+    Merge query windows so that each reading is only downloaded once.
+
+    :param windows: list of (startDate, endDate) tuples, in any order
+    :param maxgap: int, windows separated by up to this many days are bridged into one fetch
+    :return: list of non-overlapping (startDate, endDate) ranges sorted by start
+    """
+    ranges = []
+    for start, end in sorted(windows, key=lambda w: epochms(w[0])):
+        if ranges and epochms(start) - epochms(ranges[-1][1]) <= maxgap * 24 * 60 * 60 * 1000:
+            if epochms(end) > epochms(ranges[-1][1]):
+                ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+# Obtain data for several windows of one patient with as few requests as possible
+def planretrieve(ns_uuid, windows, maxgap=1, retrieve=None):
+    """
+    Fetch the merged covering ranges of all windows once and slice each window out in memory.
+
+    :param ns_uuid: str, patient nightscout uuid
+    :param windows: list of (startDate, endDate) tuples
+    :param maxgap: int, see mergewindows
+    :param retrieve: function with the signature of dataretrieve used to fetch each range
+    :return: dict of (startDate, endDate) -> date sorted Readings, or "" if the fetch failed
+    """
+    retrieve = retrieve or dataretrieve
+    ranges = mergewindows(windows, maxgap)
+    rangedata = [retrieve(ns_uuid, start, end)[0] for start, end in ranges]
+    return slicewindows(windows, ranges, rangedata)
+
+# Slice each window out of the fetched covering ranges
+def slicewindows(windows, ranges, rangedata):
+    windowdata = {}
+    for (start, end), data in zip(ranges, rangedata):
+        for window in windows:
+            wstart, wend = epochms(window[0]), epochms(window[1])
+            if epochms(start) <= wstart and wend <= epochms(end):
+                windowdata[window] = data.window(wstart, wend) if data else data
+    return windowdata
 
 # Subset sugars from data
 def sugarreadings(data):
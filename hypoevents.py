@@ -0,0 +1,109 @@
+"""
+This module counts hypoglycemic events as runs of consecutive readings below a threshold.
+
+Readings of any number of groups (days, patients or both) are processed at once: duplicates are dropped with a
+time-gap mask, runs are found where the below threshold mask changes, and runs are counted per group with bincount.
+"""
+import numpy as np
+
+DEDUPMS = 3 * 60 * 1000  # readings closer than this to the last kept one are duplicates
+
+# Run settings per CGM brand
+#   minrun: readings in a row below the threshold that make an event
+#   maxgap: ms between two readings of a run before it is broken, None to never break runs on gaps
+BRANDS = {
+    "libre": {"minrun": 2, "maxgap": None},
+    "dexcom": {"minrun": 3, "maxgap": None},
+}
+
+
+def groupstarts(groups, n):
+    """
+    :param groups: array of non-decreasing group numbers per reading, or None for a single group
+    :param n: int, number of readings
+    :return: bool array, True at the first reading of each group
+    """
+    starts = np.zeros(n, dtype=bool)
+    if n:
+        starts[0] = True
+        if groups is not None:
+            starts[1:] = groups[1:] != groups[:-1]
+    return starts
+
+def dedup(dates, mingap=DEDUPMS, groups=None):
+    """
+    Keep a reading only when it is at least mingap after the last kept reading of its group.
+
+    :param dates: sorted array of epoch ms
+    :param mingap: int, ms
+    :param groups: array of non-decreasing group numbers per reading, or None for a single group
+    :return: bool array, readings to keep
+    """
+    gaps = np.diff(dates)
+    if (gaps < 0).any():
+        raise ValueError("dedup needs dates sorted over all groups")
+    starts = groupstarts(groups, len(dates))
+    keep = starts.copy()
+    keep[1:] |= gaps >= mingap  # at least mingap after the previous reading, so after the last kept one too
+    if keep.all():
+        return keep
+
+    # Within a cluster of close readings, step from kept reading to the first one mingap later. All clusters take
+    # their steps together, the last few are walked one by one.
+    nextfar = np.searchsorted(dates, dates + mingap)
+    kept = np.flatnonzero(keep)
+    ends = np.append(kept[1:], len(dates))
+    current = nextfar[kept]
+    spread = current < ends  # clusters spanning more than mingap, the only ones keeping more than one reading
+    current, ends = current[spread], ends[spread]
+    while len(current) > 16:
+        keep[current] = True
+        current = nextfar[current]
+        spread = current < ends
+        current, ends = current[spread], ends[spread]
+
+    steps = nextfar.tolist() if len(current) else []
+    for i, end in zip(current.tolist(), ends.tolist()):
+        while i < end:
+            keep[i] = True
+            i = steps[i]
+    return keep
+
+def runs(below, groups=None, dates=None, maxgap=None):
+    """
+    :param below: bool array, readings below the threshold
+    :param groups: array of non-decreasing group numbers per reading, runs never span two groups
+    :param dates: array of epoch ms, needed with maxgap
+    :param maxgap: int, ms between two readings that breaks a run, or None
+    :return: (index of the first reading, length) of each run
+    """
+    breaks = groupstarts(groups, len(below))
+    breaks[1:] |= ~below[:-1]
+    if maxgap is not None:
+        breaks[1:] |= np.diff(dates) > maxgap
+    first = below & breaks
+    runid = np.cumsum(first) - 1
+    return np.flatnonzero(first), np.bincount(runid[below], minlength=first.sum())
+
+def hypoevents(values, threshold, brand="dexcom", groups=None, ngroups=None, dates=None, minrun=None, maxgap=None):
+    """
+    :param values: array of glucose values, deduplicated and sorted by date within each group
+    :param threshold: glucose value the readings of an event are below
+    :param brand: str, CGM brand whose run settings (see BRANDS) are used unless minrun or maxgap are given
+    :param groups: array of non-decreasing group numbers 0..ngroups-1 per reading, or None for a single group
+    :param ngroups: int, number of groups (defaults to the highest group number + 1)
+    :param dates: array of epoch ms, needed when a maxgap is used
+    :param minrun: int, readings in a row that make an event
+    :param maxgap: int, ms between two readings that breaks a run
+    :return: array of event counts per group
+    """
+    settings = BRANDS.get(brand, BRANDS["dexcom"])
+    minrun = settings["minrun"] if minrun is None else minrun
+    maxgap = settings["maxgap"] if maxgap is None else maxgap
+
+    starts, lengths = runs(values < threshold, groups, dates, maxgap)
+    events = starts[lengths >= minrun]
+    if groups is None:
+        return np.array([len(events)])
+    ngroups = int(groups[-1]) + 1 if ngroups is None and len(groups) else ngroups or 0
+    return np.bincount(groups[events], minlength=ngroups)
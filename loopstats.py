@@ -20,12 +20,20 @@ Glycemic Management Indicator (GMI)
 import warnings
 warnings.filterwarnings("ignore")
 from datetime import datetime, timedelta
-import csv
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm  # For progress bar
-from multiprocessing import Manager
 from sugarstats import *
-import pandas as pd
+from nscache import cachedretrieve, evict, loadcached
+from batchstats import batchstats
+from prefixindex import PrefixIndex
+from resultstore import ResultStore
+from checkpoint import Checkpoint, patientkey
+from streamwriter import idkey
+from tableio import readrows, openwriter
+from timefilter import filterbytime
+from functools import partial
+import runreport
+import time
 
 # Global variables
 periods = [-30, 30, 60, 90, 180, 360]
@@ -33,106 +41,144 @@ periods = [-30, 30, 60, 90, 180, 360]
 periods.sort()
 
 debug = False
-def convert_to_utc(time_str, timezone_str):
+@runreport.stage("filter_by_time_np")
+def filter_by_time_np(data, start_time, end_time, tz="UTC"):
     """
-    Convert a 24-hour time string and a timezone to UTC time.
+    Filters readings by local time of day, including midnight crossing cases.
 
-    :param time_str: str, time in "HH:MM" format
-    :param timezone_str: str, timezone (e.g., "America/New_York", "Asia/Tokyo")
-    :return: str, UTC time in "HH:MM" format
-    """
-    # Parse the time string into a datetime object
-    local_time = datetime.strptime(time_str, "%H:%M")
-
-    # Localize the time to the given timezone
-    local_tz = pytz.timezone(timezone_str)
-    localized_time = local_tz.localize(local_time)
-
-    # Convert to UTC
-    utc_time = localized_time.astimezone(pytz.utc)
-
-    # Format UTC time as "HH:MM"
-    return utc_time.strftime("%H:%M")
-
-
-def filter_by_time_np(data, start_time, end_time):
-    """
-    Filters a dataset using NumPy & Pandas for high-speed time filtering, including midnight crossing cases.
-
-    :param data: list of dictionaries, each containing a "dateString" field in ISO format.
+    :param data: Readings, columnar batch with epoch ms dates.
     :param start_time: str, start time in "HH:MM" format (24-hour).
     :param end_time: str, end time in "HH:MM" format (24-hour).
-    :return: filtered list of dictionaries.
+    :param tz: str, timezone the times are given in (e.g., "America/New_York", "Asia/Tokyo").
+    :return: filtered Readings.
     """
-    # Convert JSON data to DataFrame
-    df = pd.DataFrame(data)
-
-    # Convert 'dateString' to pandas datetime
-    df["time"] = pd.to_datetime(df["dateString"]).dt.time
+    return filterbytime(data, [(start_time, end_time)], tz)
 
-    # Convert start & end time to datetime.time objects
-    start_time = pd.to_datetime(start_time, format="%H:%M").time()
-    end_time = pd.to_datetime(end_time, format="%H:%M").time()
-
-    # Fast filtering using NumPy
-    if start_time <= end_time:
-        mask = (df["time"] >= start_time) & (df["time"] <= end_time)
-    else:
-        mask = (df["time"] >= start_time) | (df["time"] <= end_time)
 
-    return df[mask].drop(columns=["time"]).to_dict(orient="records")
-
-
-def process_stats(row, startdate, enddate, ptNSCol, days, base_columns, starttime, endtime):
+def process_stats(row, data, startdate, enddate, ptNSCol, days, base_columns, starttime, endtime, index=None):
     print(row)
-    """Process A1c data and return relevant statistics or empty values if no data."""
-    # Retrieve data
-    data, response_url = dataretrieve(row[ptNSCol], startdate, enddate)
+    """
+    Process the window's data and return relevant statistics or empty values if no data.
+
+    :param index: PrefixIndex over the time filtered readings of this window (and possibly others) to take the stats from
+    """
     if not data:
         if debug:
             print("no data on nightscout!")
         return ("",) * len(base_columns), []
 
+    if index is None:
+        data = timefiltered(row, data, enddate, ptNSCol, starttime, endtime)
+        if data is None:
+            return ("",) * len(base_columns), []
+
+    # Windows without readings or without pairs of readings for the fluctuation are blank, as in batch mode
+    try:
+        with runreport.stage("GMIstats"):
+            if index is None:
+                return (startdate, enddate, days) + GMIstats(data, days), data
+            return (startdate, enddate, days) + index.stats(epochms(startdate), epochms(enddate) + 1, days), data
+    except ZeroDivisionError:
+        return ("",) * len(base_columns), []
+
+# One prefix index over the time filtered readings of windows that do not overlap, None when they do
+def windowindex(row, windowdata, periods, ptNSCol, starttime, endtime):
+    """
+    :param windowdata: dict, {(startdate, enddate): readings}
+    :param periods: list of (startdate, enddate, days) to index
+    :return: (PrefixIndex or None, {(startdate, enddate): True when the time filter failed})
+    """
+    bounds = sorted((epochms(startdate), epochms(enddate), (startdate, enddate)) for startdate, enddate, days in periods)
+    if any(start <= previous for (_, previous, _), (start, _, _) in zip(bounds, bounds[1:])):
+        return None, {}
+
+    batches = []
+    failed = {}
+    for start, end, window in bounds:
+        data = windowdata[window]
+        if data:
+            data = timefiltered(row, data, window[1], ptNSCol, starttime, endtime)
+            if data is None:
+                failed[window] = True
+            else:
+                batches.append(data)
+    with runreport.stage("prefix index"):
+        return PrefixIndex(Readings.concat(batches)), failed
+
+# Readings within the time of day filter in the patient's timezone, None when the filter failed
+def timefiltered(row, data, enddate, ptNSCol, starttime, endtime, tzlookup=None):
+    """
+    :param tzlookup: function(ns_uuid, enddate) -> timezone, data_via_nsuuid.timezone by default
+    """
     # Filter by time only if valid starttime and endtime are provided
     if starttime and endtime and starttime.strip() and endtime.strip():
         try:
-            tz = timezone(row[ptNSCol], enddate)
-            starttimeutc = convert_to_utc(starttime, tz)
-            endtimeutc = convert_to_utc(endtime, tz)
-            data = filter_by_time_np(data, starttimeutc, endtimeutc)
+            tz = (tzlookup or timezone)(row[ptNSCol], enddate)
+            data = filter_by_time_np(data, starttime, endtime, tz)
         except Exception:
             if debug:
                 print("error with time")
-            return ("",) * len(base_columns), []
-
-    # Return processed stats
-    return (startdate, enddate, days) + GMIstats(data, days), data
+            return None
+    return data
 
 def adddays(startdate, days = 90):
     enddate = (datetime.fromisoformat(startdate) + timedelta(days)).isoformat().split("T")[0]
     return enddate
 
-def process_row(row, ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol, base_columns, ptHardware, starttime, endtime):
+# Build the (startdate, enddate, days) windows around the loop start date
+def loopwindows(loopstart):
+    loopperiods = []
+    first_positive_found = False
+    for i, period in enumerate(periods):
+        if period < 0:
+            loopperiods.append((adddays(loopstart, period), adddays(loopstart, -1), abs(period)))
+        elif (period > 0) & (not first_positive_found):
+            end_date = adddays(loopstart, period)
+            loopperiods.append((loopstart, end_date, abs(period)))
+            next_start_date = adddays(end_date, 1)
+            first_positive_found = True
+        else:
+            end_date = adddays(loopstart, period)
+            loopperiods.append((next_start_date, end_date, abs(period)))
+            next_start_date = adddays(end_date, 1)
+    return loopperiods
+
+def process_row(row, ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol, base_columns, ptHardware, starttime, endtime, refresh=0,
+                windowdata=None, stored=None):
+    """
+    :param windowdata: dict, data of the windows when it was already retrieved asynchronously
+    :param stored: dict, {(startdate, enddate): result} of windows computed in an earlier run
+    :return: (result row or [], {(startdate, enddate): result} of the newly computed windows, False when retrieving
+             any window failed)
+    """
+    stored = stored or {}
     results = []
+    computed = {}
+    fetched = True
     loopstart = row[ptLOOPStart]
     if loopstart:
-        loopperiods = []
-        first_positive_found = False
-        for i, period in enumerate(periods):
-            if period < 0:
-                loopperiods.append((adddays(loopstart, period), adddays(loopstart, -1), abs(period)))
-            elif (period > 0) & (not first_positive_found):
-                end_date = adddays(loopstart, period)
-                loopperiods.append((loopstart, end_date, abs(period)))
-                next_start_date = adddays(end_date, 1)
-                first_positive_found = True
-            else:
-                end_date = adddays(loopstart, period)
-                loopperiods.append((next_start_date, end_date, abs(period)))
-                next_start_date = adddays(end_date, 1)
+        loopperiods = loopwindows(loopstart)
+        missing = [(startdate, enddate) for startdate, enddate, days in loopperiods if (startdate, enddate) not in stored]
+
+        # Retrieve all periods in one go and slice them locally
+        if windowdata is None:
+            windowdata = planretrieve(row[ptNSCol], missing, retrieve=partial(cachedretrieve, refresh=refresh))
+        fetched = not any(data == "" for data in windowdata.values())
+
+        # Every window answered from one index over the patient's readings
+        index, failed = windowindex(row, windowdata, [period for period in loopperiods if period[:2] in missing],
+                                    ptNSCol, starttime, endtime)
 
         for startdate, enddate, days in loopperiods:
-            result, data = process_stats(row, startdate, enddate, ptNSCol, days, base_columns, starttime, endtime)
+            if (startdate, enddate) in stored:
+                result = stored[(startdate, enddate)]
+            elif (startdate, enddate) in failed:
+                result = ("",) * len(base_columns)
+            else:
+                result, data = process_stats(row, windowdata[(startdate, enddate)], startdate, enddate, ptNSCol, days,
+                                             base_columns, starttime, endtime, index)
+                if result[0]:
+                    computed[(startdate, enddate)] = list(result)
             results.extend(result)
 
         if any(results[i] for i in range(0, len(results), len(base_columns))):
@@ -142,72 +188,200 @@ def process_row(row, ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol, base_columns, ptH
                 row[ptHardware],
                 loopstart,
                 *results
-            ]
-    return []  # Return empty lists instead of None
-
+            ], computed, fetched
+    return [], computed, fetched  # Return empty lists instead of None
 
-def loopstats(snap , name="loop", starttime = "", endtime = ""): # enter a time
-    with open(snap, mode="r") as snapdata:
-        readfile = csv.reader(snapdata)
-        headers = next(readfile)
 
-        # Define column indices
-        ptIDCol = headers.index('key')
-        ptLinkCol = headers.index('link')
-        ptNSCol = headers.index('ns_uuid')
-        ptLOOPStart = headers.index('OSAID startdate')
-        ptHardware = headers.index('Software')
-
-        base_columns = ["startdate", "enddate", "days", "cgm", "count", "percentdata", "avgglucose", "STD", "ptGMI", "TBR", "TIR (3.9–10 mmol/L)",
-                        "TAR","verylow (<3 mmol/L)", "low (3–3.9 mmol/L)", "high (10–13.9 mmol/L)", "veryhigh (>13.8 mmol/L)",
-                        "timefluc", "timerapid"]
+# Same results as process_row for many patients at once, from the local data cache only
+def process_batch(rows, ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol, base_columns, ptHardware, starttime, endtime):
+    """
+    :return: list of (row, (result row or [], {(startdate, enddate): result} of the computed windows, True))
+    """
+    # Every window of every patient, with its cached and filtered readings
+    patients = []
+    for row in rows:
+        windows = []
+        if row[ptLOOPStart]:
+            for startdate, enddate, days in loopwindows(row[ptLOOPStart]):
+                data, response_url = loadcached(row[ptNSCol], startdate, enddate)
+                if data:
+                    # Only timezones looked up by earlier runs, a patient without one gets blank windows
+                    data = timefiltered(row, data, enddate, ptNSCol, starttime, endtime, tzlookup=cachedtimezone)
+                windows.append((startdate, enddate, days, data))
+        patients.append((row, windows))
+
+    # Stats of all windows in one pass
+    windows = [window for row, windows in patients for window in windows]
+    stats = iter(batchstats([data if data else Readings() for startdate, enddate, days, data in windows],
+                            [days for startdate, enddate, days, data in windows]))
+
+    outputs = []
+    for row, windows in patients:
+        results = []
+        computed = {}
+        for startdate, enddate, days, data in windows:
+            stat = next(stats)
+            if data and stat:
+                result = (startdate, enddate, days) + stat
+                computed[(startdate, enddate)] = list(result)
+            else:
+                result = ("",) * len(base_columns)
+            results.extend(result)
 
-        final_headers = ["ID", "link", "ptHardware", "loopstart"] + [f"{col} ({str(period)})" for period in periods for col in base_columns]
+        if any(results[i] for i in range(0, len(results), len(base_columns))):
+            outputs.append((row, ([
+                int(float(row[ptIDCol].replace(',', ''))),
+                row[ptLinkCol],
+                row[ptHardware],
+                row[ptLOOPStart],
+                *results
+            ], computed, True)))
+        else:
+            outputs.append((row, ([], computed, True)))
+    return outputs
 
-        # Read all rows into a list to count them for progress bar
-        rows = list(readfile)
 
-        if debug:
-            # Single-process debugging
-            results = []
-            for row in tqdm(rows, total=len(rows), desc="Processing Patients"):
-                print(row)
+def loopstats(snap , name="loop", starttime = "", endtime = "", refresh=0, mode="process", incremental=True,
+              resume=False, order=False, fmt="csv", batchsize=500, report=True, profile=None): # enter a time
+    """
+    :param mode: str, "process" retrieves and computes in a pool of 4 processes, "async" retrieves all patients
+                 through one asynchronous connection pool and only computes stats in worker processes, "batch"
+                 computes the stats of `batchsize` patients at a time from the local data cache without retrieving
+                 (with a time filter, only the timezones cached by earlier runs are used)
+    :param incremental: bool, reuse the stored results of windows computed in earlier runs
+    :param resume: bool, skip the patients an interrupted run already finished
+    :param order: bool, sort the output by patient ID instead of writing patients as they finish
+    :param fmt: str, "csv" or "parquet" results file; snap may be either
+    :param report: bool, write the time spent per stage (over all worker processes), bytes downloaded and retries to
+                   gitignore/report_<name>_<starttime>-<endtime>.json and .csv
+    :param profile: str, key or ns_uuid of a single patient to run under cProfile in this process instead of the
+                    cohort, the profile is saved to gitignore/profile_<name>.prof
+    """
+    # Keep the local data cache within its size limit
+    evict()
+
+    headers, rows = readrows(snap)
+
+    # Define column indices
+    ptIDCol = headers.index('key')
+    ptLinkCol = headers.index('link')
+    ptNSCol = headers.index('ns_uuid')
+    ptLOOPStart = headers.index('OSAID startdate')
+    ptHardware = headers.index('Software')
+
+    base_columns = ["startdate", "enddate", "days", "cgm", "count", "percentdata", "avgglucose", "STD", "ptGMI", "TBR", "TIR (3.9–10 mmol/L)",
+                    "TAR","verylow (<3 mmol/L)", "low (3–3.9 mmol/L)", "high (10–13.9 mmol/L)", "veryhigh (>13.8 mmol/L)",
+                    "timefluc", "timerapid"]
+
+    final_headers = ["ID", "link", "ptHardware", "loopstart"] + [f"{col} ({str(period)})" for period in periods for col in base_columns]
+    base_types = ["str", "str", "int", "str", "int"] + ["float"] * 13
+    final_types = ["int", "str", "str", "str"] + [kind for period in periods for kind in base_types]
+
+    if profile:
+        # One patient under cProfile, nothing is stored
+        row = next((row for row in rows if profile in (row[ptIDCol], row[ptNSCol])), None)
+        if row is None:
+            print(f"Patient {profile} not found in {snap}!")
+            return None
+        result, computed, fetched = runreport.profiled(
+            f"gitignore/profile_{str(name)}.prof", process_row, row, ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol,
+            base_columns, ptHardware, starttime, endtime, refresh)
+        runreport.describe(runreport.report(f"gitignore/profile_{str(name)}", name=name, patients=1, profile=profile))
+        return result
+
+    started = time.perf_counter()
+
+    # Results of earlier runs, only new or invalidated windows are computed again
+    timefilter = f"{starttime}-{endtime}" if starttime and endtime else ""
+    store = ResultStore(f"gitignore/resultstore_{str(name)}.csv", STATSVERSION, settle=refresh)
+    def storedfor(row):
+        return store.patient(row[ptNSCol], timefilter) if incremental else {}
+
+    # Results are written as patients finish
+    results = openwriter(f"gitignore/results_{str(name)}_{starttime}-{endtime}", final_headers, final_types,
+                         orderby=(lambda result: idkey(result[0])) if order else None, fmt=fmt)
+
+    # Finished patients are checkpointed durably as they complete
+    checkpoint = Checkpoint(f"gitignore/checkpoint_{str(name)}_{starttime}-{endtime}.csv", resume)
+    results.writerows(result for result in checkpoint.outputs() if result)
+    rows = [row for row in rows if patientkey(row, ptIDCol, ptNSCol) not in checkpoint.done]
+
+    def keep(row, output):
+        result, computed, fetched = output
+        with runreport.stage("write"):
+            for (startdate, enddate), value in computed.items():
+                store.put(row[ptNSCol], startdate, enddate, value, timefilter)
+            # Patients whose data could not be retrieved are not done, a resumed run tries them again
+            if fetched:
+                checkpoint.put(patientkey(row, ptIDCol, ptNSCol), result)
+            if result:
+                results.writerow(result)
+        return result
+
+    if debug:
+        # Single-process debugging
+        for row in tqdm(rows, total=len(rows), desc="Processing Patients"):
+            print(row)
+            try:
+                result = keep(row, process_row(
+                    row, ptLOOPStart, ptIDCol, ptLinkCol,
+                    ptNSCol, base_columns, ptHardware, starttime, endtime, refresh, stored=storedfor(row)
+                ))
+                print(f'\nResults: {result}')
+            except Exception as e:
+                print(f"Error processing row: {e}")
+    elif mode == "batch":
+        # Stats of the locally cached data only, many patients at a time on one core
+        for chunk in tqdm(range(0, len(rows), batchsize), desc="Processing Patient Batches"):
+            for row, output in process_batch(rows[chunk:chunk + batchsize], ptLOOPStart, ptIDCol, ptLinkCol, ptNSCol,
+                                             base_columns, ptHardware, starttime, endtime):
+                keep(row, output)
+    elif mode == "async":
+        # Asynchronous retrieval, stats in a small process pool
+        from asyncretrieve import runcohort
+
+        def windowfn(row):
+            if not row[ptLOOPStart]:
+                return []
+            stored = storedfor(row)
+            return [(startdate, enddate) for startdate, enddate, days in loopwindows(row[ptLOOPStart])
+                    if (startdate, enddate) not in stored]
+
+        with tqdm(total=len(rows), desc="Processing Patients") as progress:
+            def onresult(row, output):
+                progress.update()
+                if not keep(row, output):
+                    print(f"No result found!")
+
+            computefn = partial(process_row, ptLOOPStart=ptLOOPStart, ptIDCol=ptIDCol, ptLinkCol=ptLinkCol,
+                                ptNSCol=ptNSCol, base_columns=base_columns, ptHardware=ptHardware,
+                                starttime=starttime, endtime=endtime)
+            runcohort(rows, windowfn, computefn, onresult, nsfn=lambda row: row[ptNSCol], refresh=refresh,
+                      extrafn=lambda row: {"stored": storedfor(row)})
+    else:
+        # Original parallel code, stage timings of the workers come back with their results
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            futures = {
+                executor.submit(
+                    runreport.timed, process_row, row, ptLOOPStart, ptIDCol, ptLinkCol,
+                    ptNSCol, base_columns, ptHardware, starttime, endtime, refresh, stored=storedfor(row)
+                ): row
+                for row in rows
+            }
+            for future in tqdm(as_completed(futures), total=len(rows), desc="Processing Patients"):
                 try:
-                    result = process_row(
-                        row, ptLOOPStart, ptIDCol, ptLinkCol,
-                        ptNSCol, base_columns, ptHardware, starttime, endtime
-                    )
-                    print(f'\nResults: {result}')
-                    if result:
-                        results.append(result)
+                    if not keep(futures.pop(future), runreport.untimed(future.result())):
+                        print(f"No result found!")
                 except Exception as e:
                     print(f"Error processing row: {e}")
-        else:
-            # Original parallel code
-            results = []
-
-            with ProcessPoolExecutor(max_workers=4) as executor:
-                futures = [
-                    executor.submit(
-                        process_row, row, ptLOOPStart, ptIDCol, ptLinkCol,
-                        ptNSCol, base_columns, ptHardware, starttime, endtime
-                    )
-                    for row in rows
-                ]
-                for future in tqdm(futures, total=len(rows), desc="Processing Patients"):
-                    try:
-                        result = future.result()
-                        if result:
-                            results.append(result)
-                        else:
-                            print(f"No result found!")
-                    except Exception as e:
-                        print(f"Error processing row: {e}")
-
-        # Write main results to CSV
-        with open(f"gitignore/results_{str(name)}_{starttime}-{endtime}.csv", 'w', newline='', buffering=1) as f:
-            writer = csv.writer(f)
-            writer.writerow(final_headers)  # Write header
-            writer.writerows(results)  # Write all results at once
-
-        print("Results exported.")
\ No newline at end of file
+
+    with runreport.stage("write"):
+        store.close()
+        results.close()
+        checkpoint.finish()
+    print("Results exported.")
+
+    if report:
+        runreport.describe(runreport.report(f"gitignore/report_{str(name)}_{starttime}-{endtime}", name=name, mode=mode,
+                                            patients=len(rows), starttime=starttime, endtime=endtime,
+                                            wall=time.perf_counter() - started))
\ No newline at end of file
@@ -1,15 +1,43 @@
 from a1cgmi import *
 from loopstats import *
+import argparse
+import numpy as np
 import pandas as pd
 from datetime import date, timedelta
+from tableio import readframe, writeframe
+from rolling import rolling
 
-def combinecsv(snapshot, nslist):
-    snapshot = pd.read_csv(snapshot)
+# (software name, column flagging its use, column with its start date), ties go to the first listed
+SOFTWARE = [
+    ("AAPS", "AAPS_AID_y", "AAPS_date_start"),
+    ("Loop", "Loop_AID_y", "LOOP_date_start"),
+    ("iAPS", "iAPS_AID_y", "iAPS_date_start"),
+]
+
+def mostrecentsoftware(df, software=SOFTWARE):
+    """
+    :param df: DataFrame with the flag and datetime start date columns of every software
+    :param software: list of (name, flag column, date column)
+    :return: (software name or None, its start date or NaT) per row
+    """
+    names = np.array([name for name, flag, datecol in software] + [None], dtype=object)
+    # Start dates of the software in use, NaT elsewhere (the smallest value once viewed as int64)
+    dates = np.column_stack([df[datecol].where(df[flag] == 1).to_numpy("datetime64[ns]")
+                             for name, flag, datecol in software] + [np.full(len(df), np.datetime64("NaT", "ns"))])
+    latest = dates.view("int64").argmax(axis=1)  # first of ties
+    latest[np.isnat(dates).all(axis=1)] = len(software)  # the NaT column when nothing is in use
+    return names[latest], dates[np.arange(len(df)), latest]
+
+def combinecsv(snapshot, nslist, output="gitignore/working.csv", software=SOFTWARE):
+    """
+    :param software: list of (name, flag column, date column), see mostrecentsoftware
+    """
+    snapshot = readframe(snapshot)
     snapshot["PATIENT_ID"] = snapshot["link"].str.extract(r"patient_id=(\d+)").astype("int64")
     cols = ["PATIENT_ID"] + [col for col in snapshot.columns if col != "PATIENT_ID"]
     snapshot = snapshot[cols]
 
-    nslist = pd.read_csv(nslist)
+    nslist = readframe(nslist)
 
     snapshot.rename(columns={snapshot.columns[0]: "key"}, inplace=True)
     nslist.rename(columns={nslist.columns[0]: "key"}, inplace=True)
@@ -18,42 +46,40 @@ def combinecsv(snapshot, nslist):
     df = snapshot.merge(nslist, on=snapshot.columns[0], how='inner')
 
     # Convert date columns to datetime (coerce errors so invalid/missing become NaT)
-    df['AAPS_date_start'] = pd.to_datetime(df['AAPS_date_start'], errors='coerce')
-    df['LOOP_date_start'] = pd.to_datetime(df['LOOP_date_start'], errors='coerce')
-    df['iAPS_date_start'] = pd.to_datetime(df['iAPS_date_start'], errors='coerce')
-
-    # Define a helper function that picks the software with the most recent date
-    def pick_most_recent_sw(row):
-        # Build a list of (software_name, start_date) for each software that is "used" (==1)
-        used_softwares = []
-        if row['AAPS_AID_y'] == 1 and pd.notnull(row['AAPS_date_start']):
-            used_softwares.append(("AAPS", row['AAPS_date_start']))
-        if row['Loop_AID_y'] == 1 and pd.notnull(row['LOOP_date_start']):
-            used_softwares.append(("Loop", row['LOOP_date_start']))
-        if row['iAPS_AID_y'] == 1 and pd.notnull(row['iAPS_date_start']):
-            used_softwares.append(("iAPS", row['iAPS_date_start']))
-
-        if not used_softwares:
-            return (None, None)  # or return None, or an explicit label like "No AID"
-
-        # Pick the tuple with the max date
-        most_recent = max(used_softwares, key=lambda x: x[1])
-        return (most_recent[0], most_recent[1]) # replace date with 1 month ago
-
-    # Apply the helper function row by row
-    df[["Software", "OSAID startdate"]] = df.apply(pick_most_recent_sw, axis=1, result_type="expand")
+    for name, flag, datecol in software:
+        df[datecol] = pd.to_datetime(df[datecol], errors='coerce')
+
+    # Pick the software with the most recent start date among those in use
+    df["Software"], df["OSAID startdate"] = mostrecentsoftware(df, software)
     df = df.dropna(subset=['Software'])
     df = df.dropna(subset=['ns_status'])
     df = df[df['ns_status'] != 0]
 
-    # Save the updated DataFrame to a new CSV
-    df.to_csv("gitignore/working.csv", index=False)
+    # Save the updated DataFrame as CSV or Parquet
+    writeframe(df, output)
 
 if __name__ == "__main__":
-    #a1cgmi(90)
+    parser = argparse.ArgumentParser(description="Combine the snapshot with the nightscout list and calculate loop stats")
+    parser.add_argument("--resume", action="store_true", help="skip patients finished by an interrupted run")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="file format of the combined snapshot and the results")
+    parser.add_argument("--rolling", type=int, nargs="*", metavar="DAYS",
+                        help="also output rolling series over windows of these lengths (default 14 30 90)")
+    parser.add_argument("--stride", type=int, default=7, help="days between two windows of the rolling series")
+    parser.add_argument("--profile", metavar="PATIENT",
+                        help="only run the loop stats of this patient key or ns_uuid under cProfile")
+    args = parser.parse_args()
+
+    #a1cgmi(90, resume=args.resume, fmt=args.format)
     Snapshot = "gitignore/snap(2025-03-05).csv"
     NSOutput = "gitignore/modifiedcgmstat.csv"
-    combinecsv(Snapshot, NSOutput) # output combined csv with software - gitignore/working.csv
-    loopstats('gitignore/working.csv', "cgmnight") #leave start and end time empty to process all data
+    Working = f"gitignore/working.{args.format}"
+    combinecsv(Snapshot, NSOutput, Working) # output combined snapshot with software
+    if args.profile:
+        loopstats(Working, "cgmnight", fmt=args.format, profile=args.profile)
+        raise SystemExit
+    loopstats(Working, "cgmnight", resume=args.resume, fmt=args.format) #leave start and end time empty to process all data
+    if args.rolling is not None:
+        rolling(Working, lengths=tuple(args.rolling) or (14, 30, 90), stride=args.stride, fmt=args.format)
 
     #Plan: Set the Loop start date to 1 month ago from now for all people with nightscout accounts. This script will then calc stats.
\ No newline at end of file
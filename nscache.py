@@ -0,0 +1,184 @@
+"""
+This module keeps a local on-disk cache of nightscout glucose data.
+
+Readings are stored per patient and per UTC day as columnar .npz files, alongside an index of the days that have
+already been retrieved. Only days missing from the index (or too recent to be final) are requested from the server.
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+import numpy as np
+from data_via_nsuuid import *
+import runreport
+
+# Global variables
+cachedir = "gitignore/nscache"  # set to None to disable caching
+maxbytes = 2 * 1024 ** 3  # size limit of the whole cache, enforced by evict()
+settledays = 1  # a day is final once it was fetched this many days after it ended
+CACHEVERSION = 2  # layout of the day files (1: .json entries, 2: .npz columns), older caches are dropped
+
+DAYMS = 24 * 60 * 60 * 1000
+
+
+def patientdir(ns_uuid):
+    return os.path.join(cachedir, ns_uuid)
+
+def dayms(day):
+    return epochms(day)
+
+def daystr(ms):
+    return datetime.utcfromtimestamp(ms / 1000).strftime("%Y-%m-%d")
+
+# List the UTC days touched by [startDate, endDate]
+def daysbetween(startDate, endDate):
+    first = epochms(startDate) // DAYMS
+    last = epochms(endDate) // DAYMS
+    return [daystr(day * DAYMS) for day in range(first, last + 1)]
+
+# Write a file atomically so an interrupted run never leaves a half written day behind
+def writejson(path, obj):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def writecolumns(path, data):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        np.savez(f, **data.columns())
+    os.replace(tmp, path)
+
+# Index of cached days: {"version": CACHEVERSION, "days": {day: fetched epoch seconds}, "bytes": size on disk}
+def loadindex(ns_uuid):
+    try:
+        with open(os.path.join(patientdir(ns_uuid), "index.json")) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {"version": CACHEVERSION, "days": {}, "bytes": 0}
+    if index.get("version", 1) != CACHEVERSION:
+        # Days of an older layout cannot be read back, so they all count as missing
+        shutil.rmtree(patientdir(ns_uuid), ignore_errors=True)
+        return {"version": CACHEVERSION, "days": {}, "bytes": 0}
+    return index
+
+def saveindex(ns_uuid, index):
+    writejson(os.path.join(patientdir(ns_uuid), "index.json"), index)
+
+# Determine which days have to be requested from the server
+def missingdays(index, days, refresh=0):
+    """
+    :param index: dict, patient index from loadindex
+    :param days: list of "YYYY-MM-DD" days needed
+    :param refresh: int, days before today that are refetched even when cached
+    :return: list of days to fetch
+    """
+    now = time.time() * 1000
+    forced = daystr(now - refresh * DAYMS) if refresh else None
+    missing = []
+    for day in days:
+        fetched = index["days"].get(day)
+        if fetched is None or fetched * 1000 < dayms(day) + (1 + settledays) * DAYMS:
+            missing.append(day)
+        elif forced and day >= forced:
+            missing.append(day)
+    return missing
+
+# Group consecutive days into ranges so each gap costs a single request
+def dayruns(days):
+    runs = []
+    for day in days:
+        if runs and dayms(day) - dayms(runs[-1][-1]) == DAYMS:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
+
+# Query range covering a run of consecutive days
+def runrange(run):
+    return run[0], daystr(dayms(run[-1]) + DAYMS)
+
+# Store the readings of a fetched run of days
+@runreport.stage("cache write")
+def storerun(ns_uuid, index, run, data):
+    folder = patientdir(ns_uuid)
+    os.makedirs(folder, exist_ok=True)
+
+    fetched = int(time.time())
+    for day in run:
+        entries = data.window(dayms(day), dayms(day) + DAYMS - 1)
+        path = os.path.join(folder, f"{day}.npz")
+        if os.path.exists(path):
+            index["bytes"] -= os.path.getsize(path)
+            os.remove(path)
+        if len(entries):
+            writecolumns(path, entries)
+            index["bytes"] += os.path.getsize(path)
+        index["days"][day] = fetched
+    saveindex(ns_uuid, index)
+
+# Read [startDate, endDate] back from the cache
+@runreport.stage("cache read")
+def loadcached(ns_uuid, startDate, endDate):
+    # Mark the patient as recently used for eviction
+    indexpath = os.path.join(patientdir(ns_uuid), "index.json")
+    if os.path.exists(indexpath):
+        os.utime(indexpath)
+
+    batches = []
+    for day in daysbetween(startDate, endDate):
+        path = os.path.join(patientdir(ns_uuid), f"{day}.npz")
+        if os.path.exists(path):
+            with np.load(path) as columns:
+                batches.append(Readings.fromcolumns(columns))
+    data = Readings.concat(batches).sort().window(epochms(startDate), epochms(endDate))
+    return data, jsonurl(ns_uuid, startDate, endDate)
+
+# Obtain data through the cache, same return values as dataretrieve
+def cachedretrieve(ns_uuid, startDate, endDate, refresh=0):
+    """
+    Retrieve readings between startDate and endDate, only requesting days that are not cached yet.
+
+    :param ns_uuid: str, patient nightscout uuid
+    :param startDate: str, UTC start date
+    :param endDate: str, UTC end date
+    :param refresh: int, force a refetch of the last `refresh` days before today
+    :return: (date sorted readings, url) or ("", "") if retrieval failed
+    """
+    if not ns_uuid:
+        return "", ""
+    if not cachedir:
+        return dataretrieve(ns_uuid, startDate, endDate)
+
+    index = loadindex(ns_uuid)
+    for run in dayruns(missingdays(index, daysbetween(startDate, endDate), refresh)):
+        data, response_url = dataretrieve(ns_uuid, *runrange(run))
+        if data == "":
+            return "", ""
+        storerun(ns_uuid, index, run, data)
+
+    return loadcached(ns_uuid, startDate, endDate)
+
+# Drop least recently used patients until the cache fits into maxbytes
+def evict(limit=None):
+    if not cachedir or not os.path.isdir(cachedir):
+        return
+    limit = maxbytes if limit is None else limit
+
+    patients = []
+    total = 0
+    for ns_uuid in os.listdir(cachedir):
+        indexpath = os.path.join(patientdir(ns_uuid), "index.json")
+        if not os.path.exists(indexpath):
+            continue
+        used = os.path.getmtime(indexpath)
+        size = loadindex(ns_uuid)["bytes"]
+        patients.append((used, size, ns_uuid))
+        total += size
+
+    for used, size, ns_uuid in sorted(patients):
+        if total <= limit:
+            break
+        shutil.rmtree(patientdir(ns_uuid), ignore_errors=True)
+        total -= size
@@ -0,0 +1,259 @@
+"""
+This script is a local stand-in for the nightscout sites, serving synthetic CGM traces for benchmarks and checks.
+
+Every ns_uuid is a deterministic patient: a Dexcom or Libre (lvconnect) trace with a daily cycle, meal peaks, lows and
+noise that only depend on the reading time, so any split of a range into requests returns the same readings.
+Latency, errors, undeployed sites, sensor gaps and duplicate entries are configurable. Sites are served at
+<url>/<ns_uuid>, point the other scripts at them with NSURL=<url>/{ns_uuid} (or data_via_nsuuid.nsurl). The request
+log is served as JSON at <url>/_log?since=<first entry>, for a simulator running in another process.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+
+MINUTEMS = 60 * 1000
+DAYMS = 24 * 60 * MINUTEMS
+TIMEZONES = ["America/Vancouver", "America/Edmonton", "America/Toronto", "America/Halifax", "Europe/London"]
+
+
+# Stable 32 bit hash of a value and a seed, also for arrays of integers
+def mix(value, seed):
+    if isinstance(value, str):
+        return zlib.crc32(f"{seed}:{value}".encode())
+    x = (np.asarray(value, dtype=np.uint64) + np.uint64(seed)) * np.uint64(0x9E3779B97F4A7C15)
+    x ^= x >> np.uint64(29)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    return (x >> np.uint64(32)).astype(np.int64)
+
+
+class Patient:
+    """
+    Synthetic patient of one ns_uuid.
+
+    :param ns_uuid: str
+    :param seed: int, changes every patient at once
+    :param libre: float, share of patients on a Libre
+    :param libreminutes: int, minutes between Libre readings (lvconnect uploads every 5, historic Libre data every 15)
+    :param gaps: float, share of days with a sensor gap of 2 to 8 hours
+    :param duplicates: float, share of readings uploaded twice
+    """
+
+    def __init__(self, ns_uuid, seed=0, libre=0.3, libreminutes=5, gaps=0.0, duplicates=0.0):
+        self.key = mix(ns_uuid, seed)
+        self.libre = self.key % 1000 < libre * 1000
+        self.interval = (libreminutes if self.libre else 5) * MINUTEMS
+        self.device = "lvconnect" if self.libre else "share2"
+        self.offset = self.key % self.interval  # readings are not on round minutes
+        self.mean = 110 + self.key % 70
+        self.timezone = TIMEZONES[self.key % len(TIMEZONES)]
+        self.gaps = gaps
+        self.duplicates = duplicates
+
+    def readings(self, start, end):
+        """
+        :param start: epoch ms
+        :param end: epoch ms, included
+        :return: (dates, sgv) newest first, as nightscout returns them
+        """
+        first = -(-(start - self.offset) // self.interval)
+        dates = np.arange(first, (end - self.offset) // self.interval + 1, dtype=np.int64) * self.interval + self.offset
+        clock = dates % DAYMS / DAYMS * 2 * np.pi
+        noise = mix(dates // self.interval, self.key) % 31 - 15
+        sgv = self.mean + 45 * np.sin(clock) + 60 * np.maximum(np.sin(3 * clock), 0) ** 3 + noise
+
+        # A 75 minute low on 6 days out of 10
+        dayhash = mix(dates // DAYMS, self.key + 4)
+        intolow = (dates % DAYMS - dayhash // 10 % 24 * 60 * MINUTEMS) / (75 * MINUTEMS)
+        dip = np.where((dayhash % 10 < 6) & (intolow >= 0) & (intolow < 1), np.sin(np.pi * intolow), 0)
+        sgv = sgv * (1 - dip) + 50 * dip
+        sgv = np.clip(sgv.astype(np.int64), 40, 400)
+
+        if self.gaps:
+            # A gap starting on a whole hour in the selected days
+            day = dates // DAYMS
+            dayhash = mix(day, self.key + 1)
+            gapstart = dayhash % 24 * 60 * MINUTEMS
+            gaplength = (2 + dayhash // 24 % 7) * 60 * MINUTEMS
+            ingap = (dayhash % 1000 < self.gaps * 1000) & (dates % DAYMS >= gapstart) & \
+                    (dates % DAYMS < gapstart + gaplength)
+            dates, sgv = dates[~ingap], sgv[~ingap]
+        if self.duplicates:
+            repeat = np.where(mix(dates, self.key + 2) % 1000 < self.duplicates * 1000, 2, 1)
+            dates, sgv = np.repeat(dates, repeat), np.repeat(sgv, repeat)
+        return dates[::-1], sgv[::-1]
+
+    def entries(self, start, end):
+        """get-glucose-data response body"""
+        dates, sgv = self.readings(start, end)
+        strings = np.datetime_as_string(dates.astype("datetime64[ms]"))
+        return ("[" + ",".join(f'{{"date":{date},"sgv":{value},"device":"{self.device}","type":"sgv",'
+                                f'"dateString":"{string}Z"}}'
+                                for date, value, string in zip(dates.tolist(), sgv.tolist(), strings.tolist()))
+                + "]").encode()
+
+    def profile(self):
+        """profile.json response body"""
+        return json.dumps([{"defaultProfile": "Default", "store": {"Default": {"timezone": self.timezone}}}]).encode()
+
+
+# Query date (with a trailing Z) to epoch ms
+def queryms(value):
+    return int(datetime.fromisoformat(value.rstrip("Z")).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+    # Clients dropping their keep-alive connections are not errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class Simulator:
+    """
+    Nightscout sites of any number of synthetic patients, used as `with Simulator(...) as sim:`.
+
+    :param port: int, 0 for any free port
+    :param latency: float, seconds before every answer
+    :param jitter: float, up to this many seconds added at random to the latency
+    :param errors: float, share of requests answered 503
+    :param dead: float, share of patients whose site is not deployed (404)
+    :param seed: int, changes the patients and the random errors
+    :param patient: dict of keyword arguments for Patient (libre, libreminutes, gaps, duplicates)
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, errors=0.0, dead=0.0, seed=0, **patient):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.dead = dead
+        self.seed = seed
+        self.patient = patient
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.patients = {}
+        self.log = []  # (ns_uuid, kind, started, finished, status, bytes) per request, monotonic seconds
+
+    def getpatient(self, ns_uuid):
+        with self.lock:
+            if ns_uuid not in self.patients:
+                self.patients[ns_uuid] = Patient(ns_uuid, self.seed, **self.patient)
+            return self.patients[ns_uuid]
+
+    def isdead(self, ns_uuid):
+        return mix(ns_uuid, self.seed + 3) % 1000 < self.dead * 1000
+
+    def answer(self, path, query):
+        """:return: (status, kind, body)"""
+        parts = path.strip("/").split("/", 1)
+        if len(parts) < 2:
+            return 404, "", b"not found"
+        ns_uuid, endpoint = parts
+        kind = "entries" if endpoint == "get-glucose-data" else "profile" if endpoint == "api/v1/profile.json" else ""
+        if not kind or self.isdead(ns_uuid):
+            return 404, kind, b"not found"
+        with self.lock:
+            failed = self.random.random() < self.errors
+            delay = self.latency + self.random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return 503, kind, b"service unavailable"
+        patient = self.getpatient(ns_uuid)
+        if kind == "profile":
+            return 200, kind, patient.profile()
+        try:
+            start, end = queryms(query["gte"][0]), queryms(query["lte"][0])
+        except (KeyError, ValueError):
+            return 400, kind, b"bad query"
+        return 200, kind, patient.entries(start, min(end, int(time.time() * 1000)))
+
+    def handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                started = time.monotonic()
+                url = urlsplit(self.path)
+                if url.path == "/_log":
+                    since = int(parse_qs(url.query).get("since", ["0"])[0])
+                    return self.reply(200, json.dumps(simulator.log[since:]).encode())
+                status, kind, body = simulator.answer(url.path, parse_qs(url.query))
+                self.reply(status, body)
+                simulator.log.append((url.path.strip("/").split("/")[0], kind, started, time.monotonic(), status,
+                                      len(body)))
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json" if status == 200 else "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = Server(("127.0.0.1", self.port), self.handler())
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        """NSURL template of the simulated sites"""
+        return f"http://127.0.0.1:{self.port}/{{ns_uuid}}"
+
+
+# ns_uuids of a synthetic cohort
+def cohort(n, seed=0):
+    return [f"sim{seed}-{i:05d}" for i in range(n)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic nightscout sites at http://127.0.0.1:<port>/<ns_uuid>")
+    parser.add_argument("--port", type=int, default=8080, help="0 for any free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds of latency, up to this")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of requests answered 503")
+    parser.add_argument("--dead", type=float, default=0.0, help="share of sites answering 404")
+    parser.add_argument("--gaps", type=float, default=0.0, help="share of days with a sensor gap")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="share of readings uploaded twice")
+    parser.add_argument("--libre", type=float, default=0.3, help="share of patients on a Libre")
+    parser.add_argument("--libreminutes", type=int, default=5, help="minutes between Libre readings")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    simulator = Simulator(args.port, args.latency, args.jitter, args.errors, args.dead, args.seed, libre=args.libre,
+                          libreminutes=args.libreminutes, gaps=args.gaps, duplicates=args.duplicates).start()
+    print(f"Serving nightscout sites, set NSURL={simulator.url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
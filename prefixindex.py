@@ -0,0 +1,104 @@
+"""
+This module answers the GMIstats metrics of any window of one patient from cumulative sums.
+
+The index is built once over the date sorted readings: running totals of the readings, their sum and sum of squares,
+the readings in each band and the pairs of readings in (rapid) fluctuation. A window then costs two binary searches
+and a subtraction per metric, so sweeping many windows or sliding windows no longer rescans the readings. Results are
+the same as GMIstats on the same readings: fluctuation pairs are counted exactly inside the window and the standard
+deviation comes from exact integer sums.
+"""
+import math
+import numpy as np
+from batchstats import THRESHOLDS
+from sugarstats import cgmtype, dataPercent, GMI
+
+FIELDS = ("sum", "sumsq", "verylow", "low", "high", "veryhigh", "pairs", "fluc", "rapid")
+
+
+class PrefixIndex:
+    """
+    :param data: Readings sorted by date
+    :param thresholds: dict overriding some of batchstats.THRESHOLDS
+    """
+
+    def __init__(self, data, thresholds=None):
+        limits = {**THRESHOLDS, **(thresholds or {})}
+        self.data = data
+        sgv, self.dates = data.glucose()
+        sgv = sgv.astype(np.int64)
+
+        # Pair (i - 1, i) of consecutive readings at most 6 minutes apart, stored at i
+        timedelta = np.diff(self.dates, prepend=self.dates[:1])
+        delta = np.abs(np.diff(sgv, prepend=sgv[:1])) * (1000 * 60 * 5)
+        pairs = (timedelta > 0) & (timedelta <= 6 * 60 * 1000)
+
+        columns = {
+            "sum": sgv,
+            "sumsq": sgv * sgv,
+            "verylow": sgv < limits["verylow"],
+            "low": sgv < limits["low"],
+            "high": sgv > limits["high"],
+            "veryhigh": sgv > limits["veryhigh"],
+            "pairs": pairs,
+            "fluc": pairs & (delta >= limits["fluc"] * timedelta),
+            "rapid": pairs & (delta >= limits["rapid"] * timedelta),
+        }
+        # Running totals with a leading 0, so a window [i, j) is total[j] - total[i]
+        self.totals = {name: np.concatenate(([0], np.cumsum(column, dtype=np.int64)))
+                       for name, column in columns.items()}
+
+    def positions(self, start, end, dates=None):
+        """Index range of the readings with start <= date < end, start and end may be arrays"""
+        dates = self.dates if dates is None else dates
+        return np.searchsorted(dates, start, side="left"), np.searchsorted(dates, end, side="left")
+
+    def sums(self, start, end):
+        """
+        :param start: epoch ms, or array of them
+        :param end: epoch ms (excluded), or array of them
+        :return: dict, "entries", "count" and every FIELDS entry -> total over the window(s)
+        """
+        first, last = self.positions(start, end)
+        sums = {name: total[last] - total[first] for name, total in self.totals.items()}
+        # Pairs start at the second reading of a window
+        inner = np.minimum(first + 1, last)
+        for name in ("pairs", "fluc", "rapid"):
+            sums[name] = self.totals[name][last] - self.totals[name][inner]
+        sums["count"] = last - first
+        entries = self.positions(start, end, self.data.date)
+        sums["entries"] = entries[1] - entries[0]
+        return sums
+
+    def cgm(self, start):
+        """CGM brand of the first entry at or after start"""
+        first = np.searchsorted(self.data.date, start, side="left")
+        try:
+            return cgmtype(self.data.devicename(first))
+        except IndexError:
+            return cgmtype("")
+
+    def stats(self, start, end, days=90):
+        """
+        The 15 GMIstats metrics of the readings with start <= date < end.
+
+        :param start: epoch ms
+        :param end: epoch ms, excluded
+        :param days: int, length of the window in days
+        """
+        sums = {name: int(value) for name, value in self.sums(start, end).items()}
+        cgm = self.cgm(start)
+        count = sums["count"]
+        percentdata = dataPercent(range(sums["entries"]), cgm, days)
+        avgglucose = sums["sum"] / count
+        std = math.sqrt(count * sums["sumsq"] - sums["sum"] ** 2) / count
+        TBR = sums["low"] / count * 100
+        TAR = sums["high"] / count * 100
+        TIR = 100 - TAR - TBR
+        verylow = sums["verylow"] / count * 100
+        low = (sums["low"] - sums["verylow"]) / count * 100
+        high = (sums["high"] - sums["veryhigh"]) / count * 100
+        veryhigh = sums["veryhigh"] / count * 100
+        timefluc = sums["fluc"] / sums["pairs"] * 100
+        timerapid = sums["rapid"] / sums["pairs"] * 100
+        return (cgm, count, percentdata, avgglucose, std, GMI(avgglucose), TBR, TIR, TAR,
+                verylow, low, high, veryhigh, timefluc, timerapid)
@@ -0,0 +1,172 @@
+"""
+This module holds CGM readings as parallel NumPy columns instead of a list of dicts.
+
+A batch keeps the epoch ms date (int64), the glucose value (int16, -1 for entries without sgv) and the device as a
+categorical (int16 codes into a tuple of device names). Slicing a batch returns views, not copies.
+"""
+import codecs
+import json
+from array import array
+import numpy as np
+
+
+class Readings:
+    """Columnar batch of nightscout entries sorted (usually) by date."""
+
+    __slots__ = ("date", "sgv", "device", "devices")
+
+    def __init__(self, date=(), sgv=(), device=(), devices=()):
+        self.date = np.asarray(date, dtype=np.int64)
+        self.sgv = np.asarray(sgv, dtype=np.int16)
+        self.device = np.asarray(device, dtype=np.int16)
+        self.devices = tuple(devices)
+
+    # Build a batch straight from the get-glucose-data JSON entries
+    @classmethod
+    def fromjson(cls, entries):
+        count = len(entries)
+        devices = {}
+        date = np.fromiter((entry['date'] for entry in entries), dtype=np.int64, count=count)
+        sgv = np.fromiter((entry.get('sgv', -1) for entry in entries), dtype=np.int16, count=count)
+        device = np.fromiter((devices.setdefault(entry.get('device', ""), len(devices)) for entry in entries),
+                             dtype=np.int16, count=count)
+        return cls(date, sgv, device, devices)
+
+    # Join batches, merging their device categories
+    @classmethod
+    def concat(cls, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls()
+        devices = {}
+        codes = []
+        for batch in batches:
+            lookup = np.array([devices.setdefault(name, len(devices)) for name in batch.devices], dtype=np.int16)
+            codes.append(lookup[batch.device])
+        return cls(np.concatenate([batch.date for batch in batches]),
+                   np.concatenate([batch.sgv for batch in batches]),
+                   np.concatenate(codes), devices)
+
+    def __len__(self):
+        return len(self.date)
+
+    # Slices give views, boolean masks and index arrays give copies
+    def __getitem__(self, key):
+        return Readings(self.date[key], self.sgv[key], self.device[key], self.devices)
+
+    def __eq__(self, other):
+        if not isinstance(other, Readings):
+            return NotImplemented
+        return (np.array_equal(self.date, other.date) and np.array_equal(self.sgv, other.sgv)
+                and np.array_equal(self.devicenames(), other.devicenames()))
+
+    def __repr__(self):
+        return f"Readings({len(self)} readings, devices={self.devices})"
+
+    @property
+    def hassgv(self):
+        return self.sgv >= 0
+
+    # Glucose values and their dates, for entries that have an sgv
+    def glucose(self):
+        valid = self.hassgv
+        if valid.all():
+            return self.sgv, self.date
+        return self.sgv[valid], self.date[valid]
+
+    def devicename(self, index=0):
+        return self.devices[self.device[index]]
+
+    def devicenames(self):
+        return np.array(self.devices, dtype=object)[self.device]
+
+    def issorted(self):
+        return bool(np.all(self.date[1:] >= self.date[:-1]))
+
+    # Sort from first to last date (stable, skipped when already sorted)
+    def sort(self):
+        if self.issorted():
+            return self
+        return self[np.argsort(self.date, kind="stable")]
+
+    # Readings with start <= date <= end (epoch ms), as a view
+    def window(self, start, end):
+        return self[np.searchsorted(self.date, start, side="left"):np.searchsorted(self.date, end, side="right")]
+
+    # Column dict for np.savez
+    def columns(self):
+        return {"date": self.date, "sgv": self.sgv, "device": self.device,
+                "devices": np.array(self.devices, dtype=str)}
+
+    @classmethod
+    def fromcolumns(cls, columns):
+        return cls(columns["date"], columns["sgv"], columns["device"], columns["devices"].tolist())
+
+
+class ReadingsParser:
+    """
+    Incrementally parse a get-glucose-data JSON array into Readings as bytes arrive.
+
+    feed() every chunk of the response body, then finish(). Only the unparsed tail of the body is kept in memory.
+    The order of the dates is tracked while parsing, so already sorted (or reversed) responses skip the sort.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.started = False
+        self.closed = False
+        self.date = array("q")
+        self.sgv = array("h")
+        self.device = array("h")
+        self.devices = {}
+        self.ascending = True
+        self.descending = True
+
+    def feed(self, chunk):
+        buffer = self.buffer + self.utf8.decode(chunk)
+        pos = 0
+        while not self.closed:
+            # Skip whitespace, the opening bracket and separators
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not self.started:
+                if buffer[pos] != "[":
+                    raise ValueError("get-glucose-data response is not a JSON array")
+                self.started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                self.closed = True
+                pos += 1
+                break
+            try:
+                entry, pos = self.decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # entry not complete yet, wait for more bytes
+            self.add(entry)
+        self.buffer = buffer[pos:]
+
+    def add(self, entry):
+        date = entry['date']
+        if self.date:
+            self.ascending = self.ascending and date >= self.date[-1]
+            self.descending = self.descending and date < self.date[-1]
+        self.date.append(date)
+        self.sgv.append(int(entry.get('sgv', -1)))
+        self.device.append(self.devices.setdefault(entry.get('device', ""), len(self.devices)))
+
+    # Sorted batch of everything parsed
+    def finish(self):
+        if not self.closed or self.buffer.strip():
+            raise ValueError("get-glucose-data response ended before the JSON array was complete")
+        data = Readings(np.frombuffer(self.date, dtype=np.int64), np.frombuffer(self.sgv, dtype=np.int16),
+                        np.frombuffer(self.device, dtype=np.int16), self.devices)
+        if self.ascending:
+            return data
+        if self.descending:
+            return data[::-1]
+        return data.sort()
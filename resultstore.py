@@ -0,0 +1,80 @@
+"""
+This module keeps per-window stats between runs so that a rerun only computes new or invalidated windows.
+
+Entries are keyed by (ns_uuid, window start, window end, time of day filter, stats version) and appended to a CSV
+file as they are computed. Windows that end too close to today are never stored, as their data can still change.
+"""
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+
+settledays = 2  # windows ending within this many days of today are always recomputed
+
+
+class ResultStore:
+    """
+    :param path: str, CSV file holding the stored results
+    :param version: int, stats version, entries of other versions are dropped
+    :param settle: int, days after a window's end before its result is stored (at least settledays)
+    """
+
+    def __init__(self, path, version, settle=0):
+        self.path = path
+        self.version = str(version)
+        self.cutoff = (datetime.utcnow() - timedelta(days=max(settledays, settle))).strftime("%Y-%m-%d")
+        self.results = {}  # (ns_uuid, timefilter) -> {(start, end): value}
+
+        stale = 0
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                for entry in csv.reader(f):
+                    try:
+                        ns_uuid, start, end, timefilter, version, value = entry
+                        value = json.loads(value)
+                    except ValueError:
+                        stale += 1  # line cut off by an interrupted run
+                        continue
+                    windows = self.results.setdefault((ns_uuid, timefilter), {})
+                    if version != self.version or (start, end) in windows:
+                        stale += 1
+                    if version == self.version:
+                        windows[(start, end)] = value
+
+        # Compact the file when it holds entries of an older stats version, recomputed entries or broken lines
+        if stale:
+            with open(f"{path}.tmp", 'w', newline='') as f:
+                writer = csv.writer(f)
+                for (ns_uuid, timefilter), windows in self.results.items():
+                    for (start, end), value in windows.items():
+                        writer.writerow([ns_uuid, start, end, timefilter, self.version, json.dumps(value)])
+            os.replace(f"{path}.tmp", path)
+
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    # A window is final once its end date is older than the cutoff
+    def final(self, end):
+        return end[:10] < self.cutoff
+
+    # Stored results of one patient, as {(start, end): value}, without the windows ending after the cutoff (a larger
+    # refresh than the one they were stored with), which are recomputed
+    def patient(self, ns_uuid, timefilter=""):
+        return {(start, end): value for (start, end), value in self.results.get((ns_uuid, timefilter), {}).items()
+                if self.final(end)}
+
+    def put(self, ns_uuid, start, end, value, timefilter=""):
+        if not ns_uuid or not self.final(end):
+            return
+        self.results.setdefault((ns_uuid, timefilter), {})[(start, end)] = value
+        self.writer.writerow([ns_uuid, start, end, timefilter, self.version, json.dumps(value)])
+        self.file.flush()
@@ -0,0 +1,147 @@
+"""
+This module decides whether a failed nightscout request is retried, and for how long.
+
+Failures are sorted into permanent ones (the host name does not resolve, or the site answers 401/403/404/410 as an
+undeployed instance does) and transient ones (timeouts, refused connections, 429 and 5xx answers). Permanent failures
+are never retried. Every host has a circuit breaker that opens on a permanent failure or after a few transient failures
+in a row, so later requests to that host fail at once until a single probe is let through after a cool down. Backoff
+waits are capped per request and by a time budget shared by all requests of the process, so a dead instance cannot
+hold a worker for long. The budget refills as the run goes on, so a stall early in a long run does not stop later
+requests from retrying. A policy is shared by the threads fetching the chunks of a range, its state is locked.
+"""
+import socket
+import threading
+import time
+
+FATALSTATUS = {401, 403, 404, 410}
+
+
+# Causes of an exception: chained exceptions and the wrapped errors of requests/urllib3 and aiohttp
+def causes(error):
+    seen = set()
+    pending = [error]
+    while pending:
+        error = pending.pop()
+        if not isinstance(error, BaseException) or id(error) in seen:
+            continue
+        seen.add(id(error))
+        yield error
+        pending.extend((error.__cause__, error.__context__, getattr(error, "reason", None),
+                        getattr(error, "os_error", None), *error.args))
+
+# HTTP status of a failed request, or None
+def errorstatus(error):
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+# True when retrying cannot help: DNS failures and the answers of an undeployed instance
+def isfatal(error):
+    if errorstatus(error) in FATALSTATUS:
+        return True
+    return any(isinstance(cause, socket.gaierror) or type(cause).__name__ in ("NameResolutionError",
+                                                                              "ClientConnectorDNSError")
+               for cause in causes(error))
+
+
+class Breaker:
+    """Circuit breaker of one host: closed, open until a time, then half open for a single probe."""
+
+    def __init__(self):
+        self.failures = 0
+        self.openuntil = 0
+        self.probing = False
+
+
+class RetryPolicy:
+    """
+    :param threshold: int, transient failures in a row that open a host's breaker
+    :param cooldown: float, seconds a breaker stays open after transient failures
+    :param fatalcooldown: float, seconds a breaker stays open after a permanent failure
+    :param maxwait: float, seconds of backoff one request may wait in total
+    :param budget: float, seconds of backoff all requests of this process may wait at most before the budget refills
+    :param refill: float, seconds of backoff added back to the budget per second of the run, up to `budget`
+    """
+
+    def __init__(self, threshold=5, cooldown=300, fatalcooldown=3600, maxwait=120, budget=1800, refill=0.25):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.fatalcooldown = fatalcooldown
+        self.maxwait = maxwait
+        self.budget = budget
+        self.refill = refill
+        self.available = budget
+        self.refilled = time.monotonic()
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host):
+        return self.breakers.setdefault(host, Breaker())
+
+    def allow(self, host):
+        """True when a request to host may be sent now"""
+        with self.lock:
+            breaker = self.breaker(host)
+            if time.monotonic() < breaker.openuntil:
+                return False
+            if breaker.openuntil:
+                # Half open: one probe decides whether the breaker closes again
+                if breaker.probing:
+                    return False
+                breaker.probing = True
+            return True
+
+    def success(self, host):
+        with self.lock:
+            breaker = self.breaker(host)
+            breaker.failures = 0
+            breaker.openuntil = 0
+            breaker.probing = False
+
+    def failure(self, host, error):
+        """
+        Record a failed request.
+
+        :return: bool, whether retrying is pointless: the error is permanent or the host's breaker opened
+        """
+        fatal = isfatal(error)
+        with self.lock:
+            breaker = self.breaker(host)
+            breaker.failures += 1
+            opened = fatal or breaker.probing or breaker.failures >= self.threshold
+            if opened:
+                breaker.openuntil = time.monotonic() + (self.fatalcooldown if fatal else self.cooldown)
+            breaker.probing = False
+        return opened
+
+    def abandon(self, host):
+        """A request ended without an answer either way (an unexpected error, a cancellation), let a probe through"""
+        with self.lock:
+            self.breaker(host).probing = False
+
+    def backoff(self, delay, deadline):
+        """
+        Seconds to wait before the next attempt, taken from the budget.
+
+        :param delay: float, wanted backoff
+        :param deadline: float, time.monotonic() after which the request stops retrying
+        :return: float, or None when the request should give up
+        """
+        with self.lock:
+            # Token bucket: the budget comes back at `refill` seconds per second, up to its size
+            now = time.monotonic()
+            self.available = min(self.budget, self.available + (now - self.refilled) * self.refill)
+            self.refilled = now
+            wait = min(delay, deadline - now, self.available)
+            if wait <= 0:
+                return None
+            self.available -= wait
+            return wait
+
+    def deadline(self):
+        return time.monotonic() + self.maxwait
+
+
+# Shared by all requests of this process
+policy = RetryPolicy()
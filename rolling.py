@@ -0,0 +1,124 @@
+"""
+This script produces rolling GMI, TIR and CV series per patient around the start of their AID software.
+
+Every series is taken from one prefix index over the patient's sorted readings, so each window end costs two binary
+searches whatever the window length and stride. Results are written as one row per (patient, window length, window
+end) to a CSV or Parquet table.
+"""
+import warnings
+warnings.filterwarnings("ignore")
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm  # For progress bar
+from sugarstats import cgmtype, GMI
+from nscache import cachedretrieve, evict, epochms, DAYMS
+from prefixindex import PrefixIndex
+from streamwriter import idkey
+from tableio import readrows, openwriter
+
+COLUMNS = ["days", "end", "sinceloop", "count", "percentdata", "avgglucose", "GMI", "CV", "TBR", "TIR", "TAR"]
+
+
+def rollingseries(data, lengths=(14, 30, 90), stride=1, origin=None):
+    """
+    Rolling stats of one patient, one window per stride and length over the days covered by the readings.
+
+    :param data: Readings sorted by date
+    :param lengths: window lengths in days
+    :param stride: int, days between two window ends
+    :param origin: epoch ms the window ends are aligned to and "sinceloop" counts from (defaults to the first day)
+    :return: dict of columns (COLUMNS), windows without readings are left out
+    """
+    series = {name: [] for name in COLUMNS}
+    if not len(data):
+        return series
+    index = PrefixIndex(data)
+    firstday = data.date[0] // DAYMS
+    lastday = data.date[-1] // DAYMS
+    origin = firstday if origin is None else origin // DAYMS
+    perday = np.array([96 if cgmtype(device) == "libre" else 288 for device in data.devices])
+
+    for length in lengths:
+        # Window ends (excluded) from the first full window to the day after the last reading
+        first = origin + -(-(firstday + length - origin) // stride) * stride
+        ends = np.arange(first, lastday + 2, stride)
+        sums = index.sums((ends - length) * DAYMS, ends * DAYMS)
+        count = sums["count"]
+        keep = count > 0
+        if not keep.any():
+            continue
+        ends = ends[keep]
+        sums = {name: value[keep] for name, value in sums.items()}
+        count = count[keep]
+
+        # Data percent from the CGM of the first entry of each window
+        firstentry = np.searchsorted(data.date, (ends - length) * DAYMS, side="left")
+        percentdata = sums["entries"] / (perday[data.device[firstentry]] * length) * 100
+        avgglucose = sums["sum"] / count
+        std = np.sqrt(np.maximum(count * sums["sumsq"] - sums["sum"] ** 2, 0)) / count
+        TBR = sums["low"] / count * 100
+        TAR = sums["high"] / count * 100
+
+        series["days"].extend([length] * len(ends))
+        # Windows are labelled with their last day
+        series["end"].extend(str(day) for day in (ends - 1).astype("datetime64[D]"))
+        series["sinceloop"].extend((ends - 1 - origin).tolist())
+        series["count"].extend(count.tolist())
+        series["percentdata"].extend(percentdata.tolist())
+        series["avgglucose"].extend(avgglucose.tolist())
+        series["GMI"].extend(GMI(avgglucose).tolist())
+        series["CV"].extend((std / avgglucose * 100).tolist())
+        series["TBR"].extend(TBR.tolist())
+        series["TIR"].extend((100 - TAR - TBR).tolist())
+        series["TAR"].extend(TAR.tolist())
+    return series
+
+
+def process_row(row, ptIDCol, ptNSCol, ptLOOPStart, lengths, stride, before, after, refresh=0):
+    """
+    :return: list of output rows, one per window
+    """
+    loopstart = row[ptLOOPStart]
+    if not loopstart:
+        return []
+    start = (datetime.fromisoformat(loopstart) - timedelta(before + max(lengths))).strftime("%Y-%m-%d")
+    end = min(datetime.fromisoformat(loopstart) + timedelta(after), datetime.utcnow()).strftime("%Y-%m-%d")
+    data, response_url = cachedretrieve(row[ptNSCol], start, end, refresh)
+    if not data:
+        return []
+
+    series = rollingseries(data, lengths, stride, epochms(loopstart[:10]))
+    ptID = idkey(row[ptIDCol])
+    return [[ptID, loopstart, *values] for values in zip(*(series[name] for name in COLUMNS))]
+
+
+def rolling(snap, name="rolling", lengths=(14, 30, 90), stride=7, before=90, after=360, refresh=0, fmt="csv"):
+    """
+    :param snap: str, combined snapshot (see main.combinecsv)
+    :param lengths: window lengths in days
+    :param stride: int, days between two window ends
+    :param before: int, days before the loop start the series begins
+    :param after: int, days after the loop start the series ends (or today)
+    :param fmt: str, "csv" or "parquet" output file
+    """
+    # Keep the local data cache within its size limit
+    evict()
+
+    headers, rows = readrows(snap)
+    ptIDCol = headers.index('key')
+    ptNSCol = headers.index('ns_uuid')
+    ptLOOPStart = headers.index('OSAID startdate')
+
+    results = openwriter(f"gitignore/{name}_{stride}", ["ID", "loopstart"] + COLUMNS,
+                         ["int", "str", "int", "str", "int", "int"] + ["float"] * 7, fmt=fmt)
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(process_row, row, ptIDCol, ptNSCol, ptLOOPStart, lengths, stride, before, after,
+                                   refresh) for row in rows]
+        for future in tqdm(as_completed(futures), total=len(rows), desc="Processing Patients"):
+            try:
+                results.writerows(future.result())
+            except Exception as e:
+                print(f"Error processing row: {e}")
+    results.close()
+    print("Results exported.")
@@ -0,0 +1,72 @@
+"""
+This module rolls a patient's readings up into buckets, such as the local days of a1cgmi's daily averages.
+
+A rollup holds, per bucket, the counts and sums the GMIstats metrics are made of: entries, readings, sum and sum of
+squares of the glucose values, the readings in each band and the pairs of readings in (rapid) fluctuation, built in one
+vectorized pass. Window stats over the cached readings come from prefixindex instead.
+"""
+from datetime import datetime
+import numpy as np
+import nscache
+from batchstats import THRESHOLDS
+
+QUARTERMS = 15 * 60 * 1000  # UTC offsets and their changes fall on quarter hours
+
+FIELDS = ("entries", "count", "sum", "sumsq", "verylow", "low", "high", "veryhigh", "pairs", "fluc", "rapid")
+
+
+def rollup(data, keys, thresholds=None):
+    """
+    :param data: Readings sorted by date
+    :param keys: array of non-decreasing bucket numbers per reading
+    :param thresholds: dict overriding some of batchstats.THRESHOLDS
+    :return: (bucket numbers, int64 table with one column per FIELDS entry)
+    """
+    limits = {**THRESHOLDS, **(thresholds or {})}
+    buckets, entries = np.unique(keys, return_counts=True)
+    valid = data.hassgv
+    sgv = data.sgv[valid].astype(np.int64)
+    dates = data.date[valid]
+    bucket = np.searchsorted(buckets, keys[valid])
+
+    # Pairs of consecutive readings at most 6 minutes apart, counted with the later reading
+    timedelta = np.diff(dates)
+    delta = np.abs(np.diff(sgv)) * (1000 * 60 * 5)
+    pairs = (timedelta > 0) & (timedelta <= 6 * 60 * 1000)
+
+    def count(mask, of=bucket):
+        return np.bincount(of[mask], minlength=len(buckets))
+
+    table = np.column_stack([
+        entries,
+        np.bincount(bucket, minlength=len(buckets)),
+        np.bincount(bucket, weights=sgv, minlength=len(buckets)),
+        np.bincount(bucket, weights=sgv * sgv, minlength=len(buckets)),
+        count(sgv < limits["verylow"]),
+        count(sgv < limits["low"]),
+        count(sgv > limits["high"]),
+        count(sgv > limits["veryhigh"]),
+        count(pairs, bucket[1:]),
+        count(pairs & (delta >= limits["fluc"] * timedelta), bucket[1:]),
+        count(pairs & (delta >= limits["rapid"] * timedelta), bucket[1:]),
+    ]).astype(np.int64)
+    return buckets, table
+
+# UTC offset in ms of the system timezone at an epoch ms date
+def utcoffset(ms):
+    return int((datetime.fromtimestamp(ms / 1000) - datetime.utcfromtimestamp(ms / 1000)).total_seconds() * 1000)
+
+# Local dates of epoch ms dates in the system timezone, the same as datetime.fromtimestamp
+def localdays(dates):
+    # One offset per UTC day, per quarter hour on the days the offset changes
+    days, inverse = np.unique(dates // nscache.DAYMS, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    starts = np.array([utcoffset(day * nscache.DAYMS) for day in days.tolist()], dtype=np.int64)
+    ends = np.array([utcoffset((day + 1) * nscache.DAYMS - QUARTERMS) for day in days.tolist()], dtype=np.int64)
+    offsets = starts[inverse]
+    changing = (starts != ends)[inverse]
+    if changing.any():
+        quarters, within = np.unique(dates[changing] // QUARTERMS, return_inverse=True)
+        offsets[changing] = np.array([utcoffset(quarter * QUARTERMS) for quarter in quarters.tolist()])[within.reshape(-1)]
+    return (dates + offsets).astype("datetime64[ms]").astype("datetime64[D]")
+
@@ -0,0 +1,93 @@
+"""
+This module writes result rows to CSV as they arrive instead of buffering a whole cohort in memory.
+
+Rows are written in arrival order by default. When an order is requested, rows are sorted in bounded chunks that are
+spilled to temporary files and merged when the writer is closed, so memory stays flat for any cohort size.
+"""
+import csv
+import heapq
+import os
+import tempfile
+
+
+class StreamWriter:
+    """
+    :param path: str, output CSV file
+    :param header: list, header row
+    :param orderby: function(row) -> sort key, or None to keep arrival order. Rows read back from spilled chunks
+                    are lists of strings, so the key has to accept both.
+    :param buffersize: int, rows held in memory before a sorted chunk is spilled
+    """
+
+    def __init__(self, path, header, orderby=None, buffersize=10000):
+        self.path = path
+        self.header = header
+        self.orderby = orderby
+        self.buffersize = buffersize
+        self.buffer = []
+        self.chunks = []
+        self.file = None
+
+        if orderby is None:
+            self.file = open(path, 'w', newline='', buffering=1)
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def writerow(self, row):
+        if self.orderby is None:
+            self.writer.writerow(row)
+        else:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.buffersize:
+                self.spill()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    # Sort the buffered rows and move them to a temporary chunk file
+    def spill(self):
+        fd, chunk = tempfile.mkstemp(suffix=".csv", dir=os.path.dirname(self.path) or ".")
+        with os.fdopen(fd, 'w', newline='') as f:
+            csv.writer(f).writerows(sorted(self.buffer, key=self.orderby))
+        self.chunks.append(chunk)
+        self.buffer = []
+
+    def close(self):
+        if self.orderby is not None:
+            if self.buffer:
+                self.spill()
+            # k-way merge of the sorted chunks into the output file
+            files = [open(chunk, newline='') for chunk in self.chunks]
+            try:
+                with open(self.path, 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(self.header)
+                    writer.writerows(heapq.merge(*(csv.reader(chunk) for chunk in files), key=self.orderby))
+            finally:
+                for chunk in files:
+                    chunk.close()
+            self.discard()
+        elif self.file:
+            self.file.close()
+
+    def discard(self):
+        for chunk in self.chunks:
+            os.remove(chunk)
+        self.chunks = []
+        if self.file:
+            self.file.close()
+
+
+# Sort key for patient IDs as they appear in the snapshot ("1,234") or in the results (1234)
+def idkey(value):
+    return int(float(str(value).replace(',', '')))
@@ -9,6 +9,9 @@ using an input of a nightscout query data
 import numpy as np
 from data_via_nsuuid import *
 
+# Bump whenever a metric changes so that stored results are recomputed
+STATSVERSION = 2
+
 # Calculate % Data Based on CGM
 def dataPercent(glucoselist, type, days=90):
     if type == "libre":
@@ -48,6 +51,23 @@ def timeinfluc(valdtlist, rapid = False):
                 count +=1
     return(count/events * 100)
 
+# Calculate time in fluctuation and time in rapid fluctuation in one pass over the readings
+def timeinflucnp(sgv, dates):
+    """
+    Vectorized timeinfluc: consecutive readings more than 6 minutes apart (or not after each other) are skipped.
+
+    :param sgv: array of glucose values sorted by date
+    :param dates: array of epoch ms dates
+    :return: (timefluc, timerapid) in percent
+    """
+    timedelta = np.diff(dates)
+    valid = (timedelta > 0) & (timedelta <= 6 * 60 * 1000)
+    events = int(np.count_nonzero(valid))
+    fluc = np.abs(np.diff(sgv))[valid] / timedelta[valid]
+    timefluc = int(np.count_nonzero(fluc >= (6 / (1000 * 60 * 5)))) / events * 100
+    timerapid = int(np.count_nonzero(fluc >= (11 / (1000 * 60 * 5)))) / events * 100
+    return timefluc, timerapid
+
 # Determine CGM type
 def cgmtype(device):
     if "lvconnect" in device:
@@ -55,48 +75,65 @@ def cgmtype(device):
     else:
         return "dexcom"
 
-# Calculate Stats
-def GMIstats(data, days = 90):
-    # Attempt to identify the CGM
-    try:
-        retrievedevice = data[0]['device']
-    except:
-        retrievedevice = ""
-    cgm = cgmtype(retrievedevice)
-
-    # Get percent data based on cgm brand
-    percentdata = dataPercent(data, cgm, days)
+# Calculate Stats from glucose and date arrays
+def GMIstatsnp(sgv, dates, cgm="dexcom", days=90, total=None):
+    """
+    NumPy engine behind GMIstats, returns the same 15 metrics.
 
-    # Get sugar readings
-    sgv_values, sgv_valuesdt = sugarreadings(data)
+    :param sgv: array of glucose values sorted by date
+    :param dates: array of epoch ms dates
+    :param cgm: str, "libre" or "dexcom"
+    :param days: int, length of the window in days
+    :param total: int, number of entries used for percentdata (defaults to the number of readings)
+    """
+    sgv = np.asarray(sgv)
+    dates = np.asarray(dates, dtype=np.int64)
 
     # Determine number of readings
-    count = len(sgv_values)
-
-    # Calculate time in fluctuation
-    timefluc = timeinfluc(sgv_valuesdt)
-    timerapid = timeinfluc(sgv_valuesdt, True)
+    count = len(sgv)
 
-    # Determine average glucose
-    avgglucose = sum(sgv_values) / len(sgv_values)
+    # Get percent data based on cgm brand
+    percentdata = dataPercent(range(count if total is None else total), cgm, days)
 
-    # Determine standard deviation
-    std = np.std(sgv_values)
+    # Calculate time in fluctuation
+    timefluc, timerapid = timeinflucnp(sgv, dates)
 
-    # Determine GMI
+    # Determine average glucose, standard deviation and GMI
+    avgglucose = sgv.sum().item() / count
+    std = np.std(sgv)
     ptGMI = GMI(avgglucose)
 
+    # Count the readings beyond each threshold once
+    below54 = int(np.count_nonzero(sgv < 54.047))
+    below70 = int(np.count_nonzero(sgv < 70.261))
+    above180 = int(np.count_nonzero(sgv > 180.156))
+    above250 = int(np.count_nonzero(sgv > 250.417))
+
     # Determine TBR, TAR, TIR
-    TBR = (sum(i < 70.261 for i in sgv_values))/count*100
-    TAR = (sum(i > 180.156 for i in sgv_values))/count*100
+    TBR = below70/count*100
+    TAR = above180/count*100
     TIR = 100 - TAR - TBR
 
     # Determine very lows, etc.
-    verylow = (sum(i < 54.047 for i in sgv_values))/count*100
-    low = (sum(54.047 <= i < 70.261 for i in sgv_values)) / count * 100
-    high = (sum(180.156 < i <= 250.417 for i in sgv_values)) / count * 100
-    veryhigh = (sum(i > 250.417 for i in sgv_values))/count*100
+    verylow = below54/count*100
+    low = (below70 - below54)/count*100
+    high = (above180 - above250)/count*100
+    veryhigh = above250/count*100
 
     # Return results
     return (cgm, count, percentdata, avgglucose, std, ptGMI, TBR, TIR, TAR,
-            verylow, low, high, veryhigh, timefluc, timerapid)
\ No newline at end of file
+            verylow, low, high, veryhigh, timefluc, timerapid)
+
+# Calculate Stats
+def GMIstats(data, days = 90):
+    # Attempt to identify the CGM
+    try:
+        retrievedevice = data.devicename(0)
+    except:
+        retrievedevice = ""
+    cgm = cgmtype(retrievedevice)
+
+    # Get sugar readings
+    sgv_values, sgv_dates = data.glucose()
+
+    return GMIstatsnp(sgv_values, sgv_dates, cgm, days, total=len(data))
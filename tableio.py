@@ -0,0 +1,136 @@
+"""
+This module reads and writes the snapshot, results and daily tables as CSV or Parquet.
+
+Parquet files are written with typed columns and zstd compression through pyarrow, which is only imported when a
+Parquet file is actually used. CSV stays available for every table.
+"""
+import csv
+import os
+from streamwriter import StreamWriter, idkey
+
+rowgroup = 50000  # rows per Parquet row group
+
+
+# Read a table into (headers, rows of strings) the way csv.reader would return them
+def readrows(path):
+    if not path.endswith(".parquet"):
+        with open(path, mode="r", newline='') as f:
+            readfile = csv.reader(f)
+            headers = next(readfile)
+            return headers, list(readfile)
+
+    import pandas as pd
+    df = pd.read_parquet(path)
+    columns = []
+    for name in df.columns:
+        column = df[name]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            # Same text as DataFrame.to_csv: dates only when no value has a time of day
+            dates = column.dropna()
+            timeofday = (dates - dates.dt.normalize()).dt.total_seconds().any()
+            column = column.dt.strftime("%Y-%m-%d %H:%M:%S" if timeofday else "%Y-%m-%d")
+        columns.append(["" if pd.isna(value) else str(value) for value in column])
+    return list(df.columns), [list(row) for row in zip(*columns)]
+
+# Read a table as a DataFrame
+def readframe(path):
+    import pandas as pd
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+# Write a DataFrame as CSV or Parquet depending on the file extension
+def writeframe(df, path):
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False, compression="zstd")
+    else:
+        df.to_csv(path, index=False)
+
+
+class ParquetStreamWriter:
+    """
+    Parquet counterpart of StreamWriter: rows are written in row groups of typed columns as they arrive.
+
+    :param path: str, output Parquet file
+    :param header: list, column names
+    :param types: list, "str", "int" or "float" per column; empty strings are written as nulls
+    :param orderby: function(row) -> sort key, rows are then sorted through a StreamWriter first
+    """
+
+    def __init__(self, path, header, types, orderby=None, buffersize=10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.path = path
+        self.header = header
+        self.types = types
+        self.schema = pa.schema([(name, {"str": pa.string(), "int": pa.int64(), "float": pa.float64()}[kind])
+                                 for name, kind in zip(header, types)])
+        self.buffer = []
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.sorter = None
+        if orderby is not None:
+            self.sorter = StreamWriter(f"{path}.sorting.csv", header, orderby, buffersize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writerow(self, row):
+        if self.sorter:
+            self.sorter.writerow(row)
+            return
+        self.buffer.append(row)
+        if len(self.buffer) >= rowgroup:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    @staticmethod
+    def convert(value, kind):
+        if value is None or value == "":
+            return None
+        if kind == "int":
+            return idkey(value)
+        if kind == "float":
+            return float(value)
+        return str(value)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        columns = [self.pa.array([self.convert(value, kind) for value in column], type=field.type)
+                   for column, kind, field in zip(zip(*self.buffer), self.types, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+        self.buffer = []
+
+    def close(self):
+        if self.sorter:
+            # Copy the sorted rows over in row groups
+            self.sorter.close()
+            with open(self.sorter.path, newline='') as f:
+                readfile = csv.reader(f)
+                next(readfile)
+                self.sorter = None
+                self.writerows(readfile)
+            os.remove(f"{self.path}.sorting.csv")
+        self.flush()
+        self.writer.close()
+
+
+# Open a CSV or Parquet stream writer for a table
+def openwriter(path, header, types, orderby=None, fmt="csv"):
+    """
+    :param path: str, output file without extension
+    :param header: list, column names
+    :param types: list, "str", "int" or "float" per column (only used for Parquet)
+    :param orderby: function(row) -> sort key, or None to keep arrival order
+    :param fmt: str, "csv" or "parquet"
+    """
+    if fmt == "parquet":
+        return ParquetStreamWriter(f"{path}.parquet", header, types, orderby)
+    return StreamWriter(f"{path}.csv", header, orderby)
@@ -0,0 +1,81 @@
+"""
+This module filters readings by time of day and groups them by day, for loopstats and zucara alike.
+
+Times are given as "HH:MM" strings or whole hours, in UTC or in a patient's timezone. Several windows can be
+combined, and a window whose end is before its start crosses midnight. Readings are masked in one vectorized pass and
+split into days with a single np.unique pass over the sorted day numbers.
+"""
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+DAYMS = 24 * 60 * 60 * 1000
+MINUTEMS = 60 * 1000
+
+
+# Minutes since midnight of "HH:MM" or a whole hour
+def minutes(clock):
+    if isinstance(clock, str):
+        clock = datetime.strptime(clock, "%H:%M")
+        return clock.hour * 60 + clock.minute
+    return int(clock) * 60
+
+# Wall clock epoch ms of epoch ms dates, with the UTC offset (including DST) of each reading
+def localms(dates, tz="UTC"):
+    if tz is None:
+        # A missing timezone is a failed lookup, not UTC
+        raise ValueError("no timezone")
+    if tz == "UTC":
+        return dates
+    local = pd.to_datetime(dates, unit="ms", utc=True).tz_convert(tz).tz_localize(None)
+    return local.to_numpy("datetime64[ms]").view("int64")
+
+def timeofday(dates, tz="UTC"):
+    return localms(dates, tz) % DAYMS
+
+def windowmask(time, windows, closed="both"):
+    """
+    :param time: array, time of day in ms
+    :param windows: list of (start, end) times, a window with end before start crosses midnight
+    :param closed: str, "both" keeps readings at the end time, "left" drops them
+    :return: bool array, readings inside any of the windows
+    """
+    mask = np.zeros(len(time), dtype=bool)
+    for start, end in windows:
+        start = minutes(start) * MINUTEMS
+        end = minutes(end) * MINUTEMS
+        beforeend = time <= end if closed == "both" else time < end
+        if start <= end:
+            mask |= (time >= start) & beforeend
+        else:
+            mask |= (time >= start) | beforeend
+    return mask
+
+def filterbytime(data, windows, tz="UTC", closed="both"):
+    """
+    :param data: Readings
+    :param windows: list of (start, end) times, see windowmask
+    :param tz: str, timezone the times are given in
+    :param closed: str, see windowmask
+    :return: Readings inside the windows
+    """
+    return data[windowmask(timeofday(data.date, tz), windows, closed)]
+
+def groupbyday(data, tz="UTC", daystart=0):
+    """
+    :param data: Readings sorted by date
+    :param tz: str, timezone of the days
+    :param daystart: time a day starts at, e.g. the start of a window crossing midnight to keep each night together
+    :return: dict, "YYYY-MM-DD" -> Readings of that day, in date order
+    """
+    days = (localms(data.date, tz) - minutes(daystart) * MINUTEMS) // DAYMS
+    order = None
+    if len(days) > 1 and (np.diff(days) < 0).any():  # wall clock going back over midnight at a DST change
+        order = np.argsort(days, kind="stable")
+        days = days[order]
+    unique, starts = np.unique(days, return_index=True)
+    ends = np.append(starts[1:], len(days))
+    groups = {}
+    for day, start, end in zip(unique.astype("datetime64[D]"), starts, ends):
+        groups[str(day)] = data[start:end] if order is None else data[order[start:end]]
+    return groups
@@ -1,7 +1,11 @@
+import csv
 from datetime import time
 from dateutil import parser
 import urllib.request
 from main import *
+from nscache import cachedretrieve, evict
+import timefilter
+from hypoevents import dedup, hypoevents
 import concurrent.futures
 
 def average(lst):
@@ -63,62 +67,22 @@ def writeresults(filename, data):
 
 
 def tbrcalc(data, threshold, brand):
-    totalcount = 0
-    datecount = {}
-    all_values = []
-    for key, item in data.items():
-        # Sort and deduplex
-        data_sorted = sorted(item, key=lambda x: x["dateString"])
-        deduped = []
-        last_timestamp = None
-        for entry in data_sorted:
-            # Convert dateString to a NumPy datetime64 (millisecond precision)
-            current_ts = np.datetime64(entry["dateString"], "ms")
-
-            if last_timestamp is None:
-                # First entry: always keep
-                deduped.append(entry)
-                last_timestamp = current_ts
-            else:
-                # Compute difference from the last kept entry
-                diff = current_ts - last_timestamp
-                # Keep only if ≥ 3 minutes later
-                if diff >= np.timedelta64(3, "m"):
-                    deduped.append(entry)
-                    last_timestamp = current_ts
-
-        #print(deduped)
-        values = np.array([d["sgv"] for d in deduped if "sgv" in d])
-        all_values += values.tolist()
-
-        # brand setup
-        if brand == "libre":
-            runlength = 2
-        else:
-            runlength = 3
-
-        # Boolean array: True where values < threshold
-        below_threshold = values < threshold
-        count = 0
-        current_run_length = 0
-
-        for b in below_threshold:
-            if b:
-                # Still below threshold, continue the run
-                current_run_length += 1
-            else:
-                # We've hit a value above threshold, check if the run was >= 3
-                if current_run_length >= runlength:
-                    count += 1
-                # Reset run length
-                current_run_length = 0
-
-        # If we ended on a run, check that as well
-        if current_run_length >= runlength:
-            count += 1
-
-        totalcount += count
-        datecount[key] = count
+    # All days at once, each day sorted and numbered, in date order whatever the order of the dict
+    keys, days = zip(*sorted(((key, item.sort()) for key, item in data.items()),
+                             key=lambda day: day[1].date[0] if len(day[1]) else 0)) if data else ((), ())
+    readings = Readings.concat(days)
+    groups = np.repeat(np.arange(len(days)), [len(item) for item in days])
+
+    # Deduplex: keep readings ≥ 3 minutes after the last kept one of their day
+    keep = dedup(readings.date, groups=groups) & readings.hassgv
+    values = readings.sgv[keep]
+    all_values = values.tolist()
+
+    # Runs below the threshold long enough for the brand, counted per day
+    counts = hypoevents(values, threshold, brand, groups=groups[keep], ngroups=len(days))
+    datecount = dict(zip(keys, counts.tolist()))
+    datecount = {key: datecount[key] for key in data}  # in the order of the dict
+    totalcount = sum(datecount.values())
 
     print(datecount.items())
     return totalcount, all_values, datecount
@@ -131,47 +95,9 @@ def isNowInTimePeriod(startTime, endTime, nowTime):
         # Over midnight:
         return nowTime >= startTime or nowTime <= endTime
 
-def filterbytime(data, starttime, endtime): # note that this cannot handle times crossing between midnight
-    # -------------------------------
-    # 1) Convert dateString -> numpy
-    # -------------------------------
-    date_strings = [d["dateString"] for d in data]
-    dates_full = np.array(date_strings, dtype="datetime64[ms]")
-
-    # Extract calendar dates (e.g., 2025-03-08) and time-of-day offset
-    dates_only = dates_full.astype("datetime64[D]")
-    time_of_day = dates_full - dates_only
-
-    # ---------------------------------------
-    # 2) Time-of-day filter (08:00 to 13:00)
-    # ---------------------------------------
-    start = np.timedelta64(starttime, "h")  # 08:00
-    end = np.timedelta64(endtime, "h")  # 13:00
-
-    time_mask = (time_of_day >= start) & (time_of_day < end)
-
-    # --------------------
-    # 3) Apply time filter
-    # --------------------
-    data_array = np.array(data, dtype=object)  # so we can boolean-index it
-    filtered = data_array[time_mask]
-    filtered_dates_full = dates_only[time_mask]  # date portion for the filtered items
-
-    # --------------------------
-    # 4) Group by calendar date
-    # --------------------------
-    unique_dates = np.unique(filtered_dates_full)
-
-    groups_by_date = {}
-    for day in unique_dates:
-        # Create a mask for just this date (within already-filtered data)
-        date_mask = (filtered_dates_full == day)
-
-        # Convert it back to a Python list of dicts
-        groups_by_date[str(day)] = filtered[date_mask].tolist()
-
-    return groups_by_date
-
+# Readings within [starttime, endtime) of each UTC day, grouped by the day the window starts on
+def filterbytime(data, starttime, endtime):
+    return timefilter.groupbyday(timefilter.filterbytime(data, [(starttime, endtime)], closed="left"), daystart=starttime)
 
 
 def process_single_row(row, ptIDCol, ptNSCol, startdate, enddate):
@@ -189,9 +115,9 @@ def process_single_row(row, ptIDCol, ptNSCol, startdate, enddate):
 
     try:
         # Retrieve Data
-        data, response_url = dataretrieve(ptUUID, startdate, enddate)
+        data, response_url = cachedretrieve(ptUUID, startdate, enddate)
         # CGM Type
-        cgmbrand = cgmtype(data[0]['device'])
+        cgmbrand = cgmtype(data.devicename(0))
 
         # Filter data by time
         data = filterbytime(data, 7, 13)  # e.g., selects data within 7:00-13:00
@@ -243,6 +169,9 @@ def main():
     Snapshot = "gitignore/snapshot20250116.csv"
     NSOutput = "gitignore/osaid.csv"
 
+    # Keep the local data cache within its size limit
+    evict()
+
     # Combine CSVs once (outside parallel loop)
     combinecsv(Snapshot, NSOutput)
 